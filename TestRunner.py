@@ -1,30 +1,87 @@
 import sys
+import re
 import os.path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 import threading
-import subprocess
 import time
+import collections
+import itertools
 
 import sublime
 import sublime_plugin
 
 import logging
-import logging.handlers
 
 logger = logging.getLogger('test_runner')
 
+monotonic = getattr(time, 'monotonic', time.time)
+
+DURATION_MS = re.compile(r'^\s*duration_ms\s*:\s*(?P<duration>\d+(?:\.\d*)?)\s*$', re.M)
+
 logger.debug('> loading python file "%s"', __name__)
 
 
-try:
-    # Python 3
-    from .test_runner import parsers
-    from .test_runner.decorators import throttle
-except (ValueError):
-    # Python 2
-    from test_runner import parsers
-    from test_runner.decorators import throttle
+def import_modules():
+    """Imports the modules needed to run tests. Sublime Text loads every
+    plugin on startup, so they are only imported on the first run."""
+    global subprocess, queue, parsers, affected, projects, cache, daemon, test_results
+    global history, trace, logs, details, locations, coverage, process_group, Scheduler
+
+    import subprocess
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    try:
+        # Python 3
+        from .test_runner import parsers
+        from .test_runner import affected
+        from .test_runner import projects
+        from .test_runner import cache
+        from .test_runner import daemon
+        from .test_runner import results as test_results
+        from .test_runner import history
+        from .test_runner import trace
+        from .test_runner import logs
+        from .test_runner import details
+        from .test_runner import locations
+        from .test_runner import coverage
+        from .test_runner import process as process_group
+        from .test_runner.decorators import Scheduler
+    except (ValueError):
+        # Python 2
+        from test_runner import parsers
+        from test_runner import affected
+        from test_runner import projects
+        from test_runner import cache
+        from test_runner import daemon
+        from test_runner import results as test_results
+        from test_runner import history
+        from test_runner import trace
+        from test_runner import logs
+        from test_runner import details
+        from test_runner import locations
+        from test_runner import coverage
+        from test_runner import process as process_group
+        from test_runner.decorators import Scheduler
+
+
+def initialize():
+    """Imports the modules, sets up the log file and creates the caches
+    shared by the runs, once."""
+    global initialized, project_directories, fingerprints, daemons
+    if initialized:
+        return
+
+    import_modules()
+    setup_logger()
+
+    project_directories = projects.ProjectDirectoryCache()
+    fingerprints = cache.ProjectFingerprint()
+    daemons = daemon.DaemonPool()
+    initialized = True
 
 
 def plugin_loaded():
@@ -34,10 +91,19 @@ def plugin_loaded():
     elif st_version == 2:
         package_name = os.path.basename(os.getcwd())
 
-    setup_logger()
+def plugin_unloaded():
+    if not initialized:
+        return
+
+    TestRunner.stop()
+    daemons.stop()
+
+    for hdlr in logger.handlers:
+        hdlr.close()
 
 def setup_logger():
     global logger
+    import logging.handlers
 
     log_levels = {
         'CRITICAL': logging.CRITICAL,
@@ -49,15 +115,21 @@ def setup_logger():
 
     settings.clear_on_change('log_level')
 
+    for hdlr in logger.handlers:
+        hdlr.close()
     logger.handlers = []
 
+    log_level = settings.get('log_level', 'WARNING').upper()
+
     formatter = logging.Formatter('[%(asctime)s] %(levelname)s %(message)s')
     log_path = os.path.join(sublime.installed_packages_path(), package_name + '.log')
     hdlr = logging.handlers.TimedRotatingFileHandler(log_path, interval=1, backupCount=4)
     hdlr.setFormatter(formatter)
+    if log_levels[log_level] <= logging.DEBUG:
+        # debug output is written from a background thread
+        hdlr = logs.BackgroundHandler(hdlr)
     logger.addHandler(hdlr)
 
-    log_level = settings.get('log_level', 'WARNING').upper()
     logger.setLevel(log_levels[log_level])
     logger.info('setting log level to %s' % log_level)
 
@@ -72,12 +144,25 @@ class Settings():
         if self.s is None:
             self.s = sublime.load_settings('TestRunner.sublime-settings')
 
-    def get(self, key, default=None):
+    def get(self, key, default=None, view=None):
+        """Returns a setting, looking at the (project) settings of view
+        first when one is given."""
         self.load()
-        value = self.s.get(key, default)
+        value = view.settings().get(key) if view is not None else None
+        if value is None:
+            value = self.s.get(key, default)
 
         return value or default
 
+    def get_number(self, key, default, view=None):
+        """Returns a numeric setting like get(), but keeps a 0 value."""
+        self.load()
+        value = view.settings().get(key) if view is not None else None
+        if value is None:
+            value = self.s.get(key)
+
+        return default if value is None else value
+
     def set(self, key, value):
         self.load()
 
@@ -94,22 +179,151 @@ class Settings():
         self.s.clear_on_change(key)
 
 
+def storage_path(*parts):
+    """Returns a path inside the package cache directory."""
+    try:
+        base_path = sublime.cache_path()
+    except AttributeError:
+        # Sublime Text 2 has no cache directory
+        base_path = sublime.installed_packages_path()
+
+    return os.path.join(base_path, package_name, *parts)
+
+
+def result_cache():
+    global results
+    if results is None:
+        results = cache.ResultCache(
+            storage_path('results.json'),
+            settings.get('result_cache_size', 32)
+        )
+
+    return results
+
+
+def timing_history_path(working_directory, suffix):
+    import hashlib
+    key = hashlib.sha1(working_directory.encode('utf-8')).hexdigest()[:16]
+
+    return storage_path('history', key + '.' + suffix)
+
+
+def timing_history(working_directory):
+    path = timing_history_path(working_directory, 'json')
+    if path not in timing_histories:
+        timing_histories[path] = history.TimingHistory(path)
+
+    return timing_histories[path]
+
+
+def run_log(working_directory):
+    path = timing_history_path(working_directory, 'log')
+    if path not in run_logs:
+        run_logs[path] = history.RunLog(path)
+
+    return run_logs[path]
+
+
 def project_directory(path):
-    path = os.path.normpath(os.path.dirname(path))
-    path_parts = path.split(os.path.sep)
-    spec_filenames = settings.get('test_spec_filenames', [])
-
-    while path_parts:
-        for spec_directory in spec_filenames:
-            joined = os.path.normpath(
-                os.path.sep.join(path_parts + [spec_directory])
-            )
+    directory = os.path.normpath(os.path.dirname(path))
+    project_directory_path = project_directories.resolve(
+        directory,
+        settings.get('test_spec_filenames', [])
+    )
+    logger.debug(' |- project directory cache: %d hits, %d misses',
+        project_directories.hits, project_directories.misses)
+
+    return project_directory_path
+
 
-            if os.path.exists(joined):
-                project_directory_path = os.path.normpath(os.path.sep.join(path_parts))
-                return project_directory_path
+def expand_command(command, **placeholders):
+    """Replaces {name} placeholders in a command, leaving any other braces
+    (e.g. shell variables) untouched."""
+    for name, value in placeholders.items():
+        command = command.replace('{%s}' % name, str(value))
 
-        path_parts.pop()
+    return command
+
+
+def shell_quote(value):
+    if re.match(r'^[\w@%+=:,./-]+$', value):
+        return value
+
+    if os.name == 'nt':
+        return '"%s"' % value.replace('"', '\\"')
+
+    return "'%s'" % value.replace("'", "'\"'\"'")
+
+
+def expand_files(command, files):
+    """Expands the {files} placeholder of a command. A bare placeholder gets
+    every file shell quoted, while a quoted one, as in FILES="{files}", gets
+    the files separated by spaces and escaped for those quotes."""
+    joined = ' '.join(files)
+    if os.name == 'nt':
+        double_quoted = joined.replace('"', '\\"')
+    else:
+        double_quoted = re.sub(r'(["\\$`])', r'\\\1', joined)
+    command = command.replace('"{files}"', '"%s"' % double_quoted)
+    command = command.replace("'{files}'", "'%s'" % joined.replace("'", "'\"'\"'"))
+
+    return expand_command(command, files=' '.join(shell_quote(f) for f in files))
+
+
+def affected_test_files(working_directory, path):
+    return affected.affected_tests(
+        working_directory,
+        path,
+        settings.get('test_file_conventions', []),
+        settings.get('test_file_pattern', r'(^|/)(tests?|specs?)/|[._-](spec|test)\.[^/]+$'),
+        settings.get('test_dependency_index', False)
+    )
+
+
+def prioritize_command(command, working_directory):
+    """Expands the {order} and {order_file} placeholders with the known
+    tests of the project, previously failed first and then fastest first."""
+    if '{order}' not in command and '{order_file}' not in command:
+        return command
+
+    timings = timing_history(working_directory)
+    order = timings.prioritized()
+
+    order_file = timing_history_path(working_directory, 'order.txt')
+    try:
+        if not os.path.isdir(os.path.dirname(order_file)):
+            os.makedirs(os.path.dirname(order_file))
+        with open(order_file, 'w') as f:
+            f.write(''.join(description + '\n' for description in order))
+    except (IOError, OSError):
+        logger.exception('could not write test order to "%s"', order_file)
+
+    return expand_command(
+        command,
+        order=' '.join(shell_quote(description) for description in order),
+        order_file=shell_quote(order_file)
+    )
+
+
+def shard_count():
+    shards = settings.get('test_shards', 1)
+    if shards == 'auto':
+        import multiprocessing
+        shards = multiprocessing.cpu_count()
+
+    return max(int(shards), 1)
+
+
+def shard_commands(command):
+    shards = shard_count()
+    if shards > 1 and '{shard}' not in command:
+        logger.warning('test_shards is %d but the command has no {shard} placeholder, running a single process', shards)
+        shards = 1
+
+    return [
+        expand_command(command, shard=shard, total_shards=shards)
+        for shard in range(1, shards + 1)
+    ]
 
 
 class RunTestsCommand(sublime_plugin.TextCommand):
@@ -117,46 +331,182 @@ class RunTestsCommand(sublime_plugin.TextCommand):
 
     def run(self, *args, **kwargs):
         #print('RunTestsCommand.run', args, kwargs)
+        initialize()
         logger.debug('RunTestsCommand was triggered with arguments: %s' % (kwargs))
         command = settings.get('test_command')
         if 'with_coverage' in kwargs and kwargs['with_coverage']:
             command = settings.get('test_with_coverage_command')
 
+        working_directory = project_directory(self.view.file_name())
+        logger.debug(' |- working directory is "%s"' % working_directory)
+
+        if not working_directory:
+            return
+
+        if kwargs.get('affected') and not kwargs.get('with_coverage'):
+            files = set()
+            for path in kwargs.get('paths') or [self.view.file_name()]:
+                files.update(affected_test_files(working_directory, path))
+            files = sorted(files)
+            logger.debug(' |- affected test files are %s', files)
+            if files:
+                command = expand_files(settings.get('test_affected_command', command), files)
+
+        watch = (settings.get('test_watch', False, self.view) and
+                 not kwargs.get('with_coverage') and not kwargs.get('affected'))
+        if watch:
+            command = settings.get('test_watch_command', command, self.view)
+
         logger.debug(' |- command to execute is "%s"' % command)
 
-        working_directory = project_directory(self.view.file_name())
-        logger.debug('  |- working directory is "%s"' % working_directory)
+        TestRunner.start(self.view, working_directory, command, watch, bool(kwargs.get('with_coverage')))
+
+
+def busy_policy():
+    """Returns what to do with a run requested while another is active:
+    'restart' it, 'queue' one run after it, or 'ignore' the request."""
+    policy = settings.get('test_busy_policy')
+    if policy in ('restart', 'queue', 'ignore'):
+        return policy
+
+    return 'restart' if settings.get('test_override') else 'ignore'
+
 
-        if working_directory:
-            TestRunner.start(self.view, working_directory, command)
+def concurrency_limit():
+    """Returns how many projects can run their tests at the same time."""
+    try:
+        return max(1, int(settings.get('test_concurrency', 2)))
+    except (TypeError, ValueError):
+        return 1
 
 
 class TestRunner():
-    worker = None
+    """Keeps one worker per project directory. Up to concurrency_limit()
+    projects run at the same time, the others wait in request order."""
+
+    workers = {}
+    pending = {}
+    waiting = collections.deque()
+    panel_owners = {}
 
     @classmethod
-    def start(self, view, working_directory, command):
-        logger.debug('TestRunner start requested')
-        if self.worker and self.worker.is_alive():
-            logger.debug(' |- there is another worker alive...')
-            if (settings.get('test_override')):
+    def start(self, view, working_directory, command, watch=False, with_coverage=False):
+        logger.debug('TestRunner start requested for "%s"', working_directory)
+        worker = self.workers.get(working_directory)
+        if worker and worker.watch and worker.is_running() and worker.command == command:
+            # the watcher reruns the tests by itself
+            worker.mark_stale()
+            return
+
+        if worker and worker.is_running():
+            logger.debug(' |- there is another worker alive for the project...')
+            policy = busy_policy()
+            if policy == 'restart':
                 logger.debug('  |- overriding current worker...')
-                self.worker.stop()
+                worker.stop()
+                worker.scheduler.stop()
+            elif policy == 'queue':
+                logger.debug('  |- queueing request after current worker')
+                self.enqueue(view, working_directory, command, watch, with_coverage)
+                return
             else:
                 logger.debug('  |- ignoring request')
                 return
 
-        logger.debug(' |- starting a new worker for tests')
-        self.worker = TestRunnerWorker(view, working_directory, command)
+        if not watch and self.running() >= concurrency_limit():
+            logger.debug(' |- %d projects running, queueing request', self.running())
+            self.enqueue(view, working_directory, command, watch, with_coverage)
+            return
+
+        self.launch(view, working_directory, command, watch, with_coverage)
+
+    @classmethod
+    def launch(self, view, working_directory, command, watch=False, with_coverage=False):
+        logger.debug(' |- starting a new %s for tests', 'watcher' if watch else 'worker')
+        self.pending.pop(working_directory, None)
+        worker = TestRunnerWorker(view, working_directory, command, watch, with_coverage)
+        self.workers[working_directory] = worker
+        self.panel_owners[worker.window.id()] = worker
+
+    @classmethod
+    def enqueue(self, view, working_directory, command, watch=False, with_coverage=False):
+        # a newer request replaces the waiting one but keeps its turn
+        self.pending[working_directory] = (view, working_directory, command, watch, with_coverage)
+        if working_directory not in self.waiting:
+            self.waiting.append(working_directory)
+
+    @classmethod
+    def running(self):
+        # watchers are idle most of the time, so they do not take a slot
+        return sum(1 for worker in self.workers.values() if worker.is_running() and not worker.watch)
+
+    @classmethod
+    def finished(self, worker):
+        # the thread may not have exited yet, so queued runs start here
+        # instead of going through start()
+        for working_directory in list(self.waiting):
+            if self.running() >= concurrency_limit():
+                break
+
+            current = self.workers.get(working_directory)
+            if current and current.is_running():
+                continue
+
+            self.waiting.remove(working_directory)
+            if working_directory in self.pending:
+                logger.debug('TestRunner starting queued request for "%s"', working_directory)
+                self.launch(*self.pending[working_directory])
+
+    @classmethod
+    def owns_panel(self, worker):
+        return self.panel_owners.get(worker.window.id()) is worker
+
+    @classmethod
+    def worker_for(self, window):
+        """Returns the worker of the active view project in a window, or
+        the last one drawing the window panel."""
+        view = window.active_view()
+        if view and view.file_name():
+            worker = self.workers.get(project_directory(view.file_name()))
+            if worker:
+                return worker
+
+        return self.panel_owners.get(window.id())
+
+    @classmethod
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+            worker.scheduler.stop()
+
+        self.pending.clear()
+        self.waiting.clear()
 
 
 class TestRunnerWorker(threading.Thread):
-    def __init__(self, view, working_directory, command):
+    def __init__(self, view, working_directory, command, watch=False, with_coverage=False):
         self.view = view
+        self.window = view.window() or sublime.active_window()
         self.working_directory = working_directory
         self.command = command
-        self.process = None
+        self.watch = watch
+        self.stale = False
+        self.with_coverage = with_coverage
+        self.output_format = settings.get('test_output_format', 'tap', view)
+        if watch:
+            self.commands = [command]
+        else:
+            self.commands = shard_commands(prioritize_command(command, working_directory))
+        self.processes = []
+        self.test_daemon = None
+        self.shards_completed = 0
+        self.stopped = False
+        self.finished = False
+        self.failed_fast = False
+        self.timed_out = False
+        self.usage = None
         self.start_time = time.time()
+        self.line_time = monotonic()
         self.timeout = settings.get('test_timeout', 60)
         self.result = {
             'passed': 0,
@@ -167,45 +517,63 @@ class TestRunnerWorker(threading.Thread):
             'missing': 0,
             'total': 0,
             'status': 'running',
-            'message': ''
+            'message': collections.deque(maxlen=settings.get('panel_max_lines') or None)
         }
+        self.tests = test_results.TestResults()
+        self.locations = locations.LocationIndex(working_directory)
+        self.failure_lines = {}
+        # files of the window views, whether they belong to the project
+        self.project_files = {}
+        self.lines_written = 0
+        self.lines_rendered = 0
+        self.message_lock = threading.Lock()
 
         threading.Thread.__init__(self)
         self.logger = logging.getLogger('test_runner.%s' % self.name)
+        self.debug = self.logger.isEnabledFor(logging.DEBUG)
+
+        if settings.get('trace_runs', False):
+            self.tracer = trace.Tracer(self.name)
+        else:
+            self.tracer = trace.NullTracer()
+
+        self.scheduler = Scheduler(settings.get('ui_refresh_rate', 25), self.is_refreshing)
+        self.scheduler.add('status', self.draw_status, 0.2, periodic=True)
+        self.scheduler.add('panel', self.draw_panel, 0.1)
+        self.scheduler.add('markers', self.draw_markers, 0.5)
+
+        self.deadline = threading.Timer(self.timeout, self.check_timeout)
+        self.deadline.daemon = True
+
+        self.clear_markers()
         self.start()
 
     def run(self):
         self.logger.debug('Testing thread started')
+        if not self.watch:
+            self.deadline.start()
         try:
-            self.check_timeout()
             self.update_status()
             self.update_panel()
 
-            self.logger.debug(' |- spawning subprocess with command "%s"', self.command)
-            self.logger.debug(' ||- working directory is "%s"', self.working_directory)
-            self.process = subprocess.Popen(
-                self.command,
-                shell=True,
-                cwd=self.working_directory,
-                universal_newlines=True,
-                bufsize=1,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-
-            tapParser = parsers.TapParser(self.process.stdout)
-            tapParser.signal['line'].add(self.stdout_line)
-            tapParser.signal['tests_planned'].add(self.tests_planned)
-            tapParser.signal['test_case'].add(self.test_case)
-            tapParser.signal['tests_completed'].add(self.tests_completed)
-            tapParser.parse()
-
-            lineParser = parsers.LineParser(self.process.stderr)
-            lineParser.signal['line'].add(self.stderr_line)
-            lineParser.parse()
-
-            self.logger.debug(' |- subprocess finished!')
-
+            cache_key = self.cache_key()
+            cached = cache_key and result_cache().get(cache_key)
+            if cached:
+                self.replay(cached)
+            else:
+                self.execute()
+                with self.tracer.span('teardown'):
+                    # a watcher records every cycle as it completes
+                    if (not self.watch and (not self.stopped or self.failed_fast) and
+                            self.result['status'] == 'executed'):
+                        timing_history(self.working_directory).record(self.tests, 1000 * (time.time() - self.start_time))
+                        run_log(self.working_directory).append(self.tests)
+                        if cache_key and not self.failed_fast:
+                            result_cache().put(cache_key, self.cached_result())
+
+            if self.with_coverage and not self.stopped:
+                with self.tracer.span('coverage'):
+                    self.read_coverage()
 
         except RuntimeError:
             print('Unexpected error running tests:')
@@ -214,30 +582,316 @@ class TestRunnerWorker(threading.Thread):
             print('Unexpected error running tests:')
             self.logger.exception('Unexpected error running tests')
 
+        self.deadline.cancel()
+        self.logger.debug(' |- ui updates: %(dispatched)d dispatched, %(coalesced)d coalesced, %(dropped)d dropped', self.scheduler.counters)
+        self.export_trace()
         self.logger.debug('Testing thread finished')
 
+        self.finished = True
+        sublime.set_timeout(lambda: TestRunner.finished(self), 0)
+
+    def read_coverage(self):
+        index = coverage.coverage_index(self.working_directory, settings.get('coverage_reports', []))
+        if index.refresh():
+            self.logger.debug(' |- coverage read for %d files', len(index.files))
+            sublime.set_timeout(lambda: self.draw_coverage(index), 0)
+
+    def draw_coverage(self, index):
+        for view in self.window.views():
+            if view.file_name():
+                draw_coverage_marks(view, index)
+
+    def export_trace(self):
+        if not self.tracer.enabled:
+            return
+
+        for name, value in self.scheduler.counters.items():
+            self.tracer.count('ui updates ' + name, value)
+
+        path = storage_path('traces', 'run-%s-%s.json' % (time.strftime('%Y%m%d-%H%M%S'), self.name))
+        try:
+            self.tracer.export(path)
+            self.logger.debug(' |- run trace written to "%s"', path)
+        except (IOError, OSError):
+            self.logger.exception('Could not write run trace')
+
+    def execute(self):
+        if settings.get('test_daemon', False) and len(self.commands) == 1 and not self.watch:
+            if settings.get('test_daemon_command'):
+                return self.execute_in_daemon()
+
+            self.logger.warning('test_daemon is enabled but test_daemon_command is not set, running without a daemon')
+
+        streams = {}
+        for shard, command in enumerate(self.commands):
+            self.logger.debug(' |- spawning subprocess with command "%s"', command)
+            self.logger.debug(' ||- working directory is "%s"', self.working_directory)
+            with self.tracer.span('spawn', shard=shard):
+                process = subprocess.Popen(
+                    process_group.limit_command(
+                        command,
+                        settings.get('test_cpu_limit'),
+                        settings.get('test_memory_limit')
+                    ),
+                    shell=True,
+                    cwd=self.working_directory,
+                    universal_newlines=True,
+                    bufsize=1,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    **process_group.group_options()
+                )
+            self.processes.append(process)
+
+            tapParser, lineParser = self.create_parsers()
+            streams[('stdout', shard)] = (process.stdout, tapParser)
+            streams[('stderr', shard)] = (process.stderr, lineParser)
+
+        self.drain(streams)
+
+        for process in self.processes:
+            returncode, usage = process_group.wait(process)
+            self.logger.debug(' ||- subprocess %d exited with %s, used %s', process.pid, returncode, usage)
+            if usage:
+                self.usage = self.usage or {'cpu': 0, 'max_rss': 0}
+                self.usage['cpu'] += usage['cpu']
+                self.usage['max_rss'] = max(self.usage['max_rss'], usage['max_rss'])
+
+        self.logger.debug(' |- subprocess finished!')
+        self.update_status()
+
+    def execute_in_daemon(self):
+        daemons.idle_timeout = settings.get('test_daemon_idle_timeout', 300)
+        self.test_daemon = daemons.get(
+            settings.get('test_daemon_command'),
+            self.working_directory,
+            settings.get('test_daemon_watch', [])
+        )
+
+        self.logger.debug(' |- requesting "%s" from daemon "%s"', self.command, self.test_daemon.command)
+        with self.tracer.span('spawn', daemon=True):
+            stdout, stderr = self.test_daemon.request(self.commands[0])
+
+        tapParser, lineParser = self.create_parsers()
+        self.drain({
+            'stdout': (stdout, tapParser),
+            'stderr': (stderr, lineParser)
+        })
+
+        daemons.release(self.test_daemon)
+        self.logger.debug(' |- daemon request finished!')
+
+    def create_parsers(self):
+        # details and durations are relative to the same stream
+        last_test_case = {'index': None, 'time': None}
+        if self.watch:
+            resultParser = parsers.WatchParser()
+        else:
+            resultParser = parsers.create(self.output_format)
+
+        def line(line):
+            # a watcher idles between cycles, the next one is timed from its own output
+            if last_test_case['time'] is None or (self.watch and self.result['status'] == 'executed'):
+                last_test_case['time'] = self.line_time
+
+        def test_case(**kwargs):
+            index = self.test_case(**kwargs)
+            self.tests.set_duration(index, 1000 * (self.line_time - last_test_case['time']))
+            last_test_case['index'] = index
+            last_test_case['time'] = self.line_time
+
+        def test_case_detail(yaml):
+            if last_test_case['index'] is not None:
+                self.test_case_detail(last_test_case['index'], yaml)
+
+        def trace(text):
+            # stack traces printed after a failure, in comments or on stderr
+            if last_test_case['index'] in self.failure_lines and ':' in text:
+                self.add_locations(last_test_case['index'], locations.frames(text))
+
+        resultParser.signal['line'].add(line)
+        if self.debug:
+            resultParser.signal['line'].add(self.stdout_line)
+        resultParser.signal['tests_planned'].add(self.tests_planned)
+        resultParser.signal['test_case'].add(test_case)
+        resultParser.signal['test_case_detail'].add(test_case_detail)
+        resultParser.signal['comment'].add(lambda comment: trace(comment))
+        resultParser.signal['tests_completed'].add(self.tests_completed)
+
+        lineParser = parsers.LineParser()
+        lineParser.signal['line'].add(trace)
+        if self.debug:
+            lineParser.signal['line'].add(self.stderr_line)
+
+        return (resultParser, lineParser)
+
+    def cache_key(self):
+        if self.watch or not settings.get('result_cache', False):
+            return None
+
+        fingerprints.ignore = settings.get('result_cache_ignore', [])
+        return fingerprints.compute(self.working_directory, self.command, len(self.commands))
+
+    def cached_result(self):
+        result = dict(self.result)
+        result['message'] = list(result['message'])
+        # failures, slowest tests and failure locations are not in the counters
+        result['tests'] = self.tests.rows()
+        trimmed = self.lines_written - len(result['message'])
+        result['failures'] = [
+            [index, line - trimmed, self.locations.lines.get(line, [])]
+            for index, line in self.failure_lines.items()
+        ]
+
+        return result
+
+    def replay(self, cached):
+        self.logger.debug(' |- project unchanged since last run, replaying cached result')
+        for line in cached['message']:
+            self.write_message(line)
+
+        for key, value in cached.items():
+            if key not in ('message', 'tests', 'failures'):
+                self.result[key] = value
+
+        self.tests.extend(cached.get('tests', ()))
+        for index, line, found in cached.get('failures', ()):
+            self.failure_lines[index] = line
+            self.add_locations(index, [tuple(location) for location in found])
+
+        self.result['cached'] = True
+        self.shards_completed = len(self.commands)
+
+        self.update_panel()
+        self.update_status()
+
+    def drain(self, streams):
+        """Reads all streams at the same time, feeding their lines to the
+        respective parsers in the order they arrive."""
+        lines = queue.Queue()
+
+        for name, (stream, parser) in streams.items():
+            reader = threading.Thread(target=self.read_stream, args=(name, stream, lines))
+            reader.daemon = True
+            reader.start()
+
+        pending = len(streams)
+        count = 0
+        while pending:
+            self.line_time, name, line = lines.get()
+            parser = streams[name][1]
+            if line is None:
+                pending -= 1
+                parser.close()
+            else:
+                if not count:
+                    self.tracer.instant('first-byte')
+                    self.tracer.begin('parse')
+                count += 1
+                parser.feed(line)
+
+        self.tracer.end('parse', lines=count)
+        self.tracer.count('lines parsed', count)
+        self.tracer.count('signals dispatched', sum(
+            parsers.dispatched(parser.signal) for stream, parser in streams.values()
+        ))
+
+    def read_stream(self, name, stream, lines):
+        try:
+            for line in iter(stream.readline, ''):
+                lines.put((monotonic(), name, line))
+        finally:
+            lines.put((monotonic(), name, None))
+
+    def is_running(self):
+        return self.is_alive() and not self.finished and not self.stopped
+
+    def is_refreshing(self):
+        # watchers only refresh the UI while a cycle runs
+        return self.is_alive() and (not self.watch or self.result['status'] == 'running')
+
+    def mark_stale(self):
+        self.logger.debug(' |- results marked stale')
+        self.stale = True
+        self.update_status()
+
+    def begin_cycle(self):
+        """Resets the results when a watcher starts a new cycle."""
+        self.logger.debug(' ||- watcher started a new cycle')
+        for counter in ('passed', 'failed', 'skipped', 'todo', 'executed', 'missing', 'total'):
+            self.result[counter] = 0
+        self.result['status'] = 'running'
+        self.shards_completed = 0
+        self.stale = False
+        self.start_time = time.time()
+        self.tests = test_results.TestResults()
+        self.failure_lines = {}
+        self.locations = locations.LocationIndex(self.working_directory)
+        with self.message_lock:
+            self.result['message'].clear()
+            self.lines_written = 0
+            self.lines_rendered = 0
+
+        sublime.set_timeout(self.clear_markers, 0)
+
     def stop(self):
-        if self.process and self.process.poll() is None:
-            self.process.terminate()
-            self.process = None
+        self.stopped = True
+        stopped = False
+        for process in self.processes:
+            # not polled, so the exit status and usage are left to wait()
+            if process.returncode is None:
+                stopped = True
+            # children may outlive the shell, so the group is always signaled
+            process_group.terminate_group(process, settings.get_number('test_kill_grace', 5))
+
+        if self.test_daemon and self.test_daemon.is_busy():
+            self.test_daemon.stop()
+            stopped = True
+
+        if stopped:
             self.logger.debug('Testing thread stopped')
 
     def tests_planned(self, start, end):
-        self.logger.debug(' ||- subprocess reported %s..%s planned tests' % (start, end))
-        self.result['total'] = end
+        self.logger.debug(' ||- subprocess reported %s..%s planned tests', start, end)
+        if self.watch and self.result['status'] == 'executed':
+            self.begin_cycle()
+        self.result['total'] += end
 
         self.update_status()
 
     def tests_completed(self):
+        self.shards_completed += 1
+        if self.shards_completed < len(self.commands):
+            self.logger.debug(' ||- subprocess reported shard tests completed (%d/%d)', self.shards_completed, len(self.commands))
+            return
+
         self.logger.debug(' ||- subprocess reported tests completed!')
         self.result['missing'] = self.result['total'] - self.result['executed']
         self.result['total'] = self.result['executed']
         self.result['status'] = 'executed'
 
+        if self.watch:
+            timing_history(self.working_directory).record(self.tests, 1000 * (time.time() - self.start_time))
+            run_log(self.working_directory).append(self.tests)
+
         self.update_panel()
         self.update_status()
 
+    def fail_fast(self, description):
+        """Stops the run on the first failure of a test that did not fail
+        on its previous run."""
+        if self.failed_fast or self.watch or not settings.get('test_fail_fast', False):
+            return
+
+        if not timing_history(self.working_directory).has_failed(description):
+            self.logger.debug(' ||- new failure, stopping the run (fail fast)')
+            self.failed_fast = True
+            self.stop()
+
     def test_case(self, status, number, description, directive):
+        if self.watch and self.result['status'] == 'executed':
+            self.begin_cycle()
+
         if status:
             self.result['passed'] += 1
             status_message = 'PASS'
@@ -251,26 +905,78 @@ class TestRunnerWorker(threading.Thread):
             self.result['failed'] += 1
             status_message = 'FAIL'
 
-        self.logger.debug(' ||- subprocess reported test case #%d result: %s' % (number, status_message))
+        # shards number their test cases independently
+        number = self.result['executed'] + 1
+
+        if self.debug:
+            self.logger.debug(' ||- subprocess reported test case #%d result: %s', number, status_message)
         self.result['executed'] += 1
 
-        self.result['message'] += '[{status}] {description}\n'.format(
+        index = self.tests.append(status_message, number, description)
+
+        if status_message == 'FAIL':
+            self.failure_lines[index] = self.lines_written
+            self.fail_fast(description)
+
+        self.write_message('[{status}] {description}\n'.format(
             status=status_message,
             number=number,
             description=description
-        )
+        ))
 
         self.update_status()
         self.update_panel()
 
+        return index
+
+    def test_case_detail(self, index, yaml):
+        # kept raw, the rest of the block is only parsed when looked at
+        self.tests.set_detail(index, yaml)
+
+        if index in self.failure_lines:
+            self.add_locations(index, locations.from_yaml(yaml))
+
+        match = 'duration_ms' in yaml and DURATION_MS.search(yaml)
+        if match:
+            self.tests.set_duration(index, float(match.group('duration')))
+
+    def add_locations(self, index, found):
+        if found:
+            self.locations.add(self.failure_lines[index], self.tests.description(index), found)
+            self.scheduler.mark('markers')
+
+    def write_message(self, line):
+        with self.message_lock:
+            self.result['message'].append(line)
+            self.lines_written += 1
+
+    def pending_message(self):
+        """Returns the lines written since the last panel update, as far as
+        they are still retained."""
+        with self.message_lock:
+            message = self.result['message']
+            pending = min(self.lines_written - self.lines_rendered, len(message))
+            self.lines_rendered = self.lines_written
+
+            return ''.join(itertools.islice(message, len(message) - pending, None))
+
     def stdout_line(self, line):
         self.logger.debug(' ||- subprocess stdout: %s', line.rstrip())
 
     def stderr_line(self, line):
         self.logger.debug(' ||- subprocess stderr: %s', line.rstrip())
 
-    @throttle(1 / 25)
     def update_status(self):
+        self.scheduler.mark('status')
+
+    def update_panel(self):
+        self.scheduler.mark('panel')
+
+    def draw_status(self):
+        with self.tracer.span('ui-update', target='status'):
+            self.render_status()
+
+    def render_status(self):
         #self.logger.debug(' |- updating status')
         if self.result['total'] > 0:
             parts = ['{executed}/{total} {status}']
@@ -283,6 +989,28 @@ class TestRunnerWorker(threading.Thread):
             if self.result[status] > 0:
                 parts.append('{{{status}}} {status}'.format(status=status))
 
+        if len(self.commands) > 1:
+            parts.append('{shards_completed}/{shards} shards')
+
+        if self.result.get('cached'):
+            parts.append('cached')
+
+        if self.failed_fast:
+            parts.append('stopped on first new failure')
+
+        if self.timed_out:
+            parts.append('timed out after {timeout}s')
+
+        if self.watch:
+            parts.append('watching')
+
+        if self.stale:
+            parts.append('stale')
+
+        if self.usage:
+            parts.append('cpu {cpu:.1f}s')
+            parts.append('peak {max_rss:.0f} MiB')
+
         spinner = settings.get('progress_spinner', '-\|/')
         ticks = int((time.time() - self.start_time) * 5)
 
@@ -290,7 +1018,7 @@ class TestRunnerWorker(threading.Thread):
         if self.result['status'] == 'running':
             message = spinner[ticks % len(spinner)] + ' ' + message
 
-        self.view.set_status('Test Runner', message.format(
+        message = message.format(
             status=self.result['status'],
             passed=self.result['passed'],
             failed=self.result['failed'],
@@ -298,28 +1026,59 @@ class TestRunnerWorker(threading.Thread):
             todo=self.result['todo'],
             executed=self.result['executed'],
             missing=self.result['missing'],
-            total=self.result['total'])
+            total=self.result['total'],
+            shards_completed=self.shards_completed,
+            shards=len(self.commands),
+            timeout=self.timeout,
+            cpu=self.usage['cpu'] if self.usage else 0,
+            max_rss=self.usage['max_rss'] / 1048576.0 if self.usage else 0
         )
 
-        if self.is_alive():
-            self.update_status()
+        self.view.set_status('Test Runner', message)
+        for view in self.window.views():
+            if self.in_project(view.file_name()):
+                view.set_status('Test Runner', message)
+
+    def in_project(self, path):
+        """Returns whether a file belongs to the project of this worker (and
+        not to a project nested in it), remembered as views come and go."""
+        if not path:
+            return False
+
+        if path not in self.project_files:
+            self.project_files[path] = (
+                path.startswith(os.path.join(self.working_directory, '')) and
+                project_directory(path) == self.working_directory
+            )
 
-    @throttle(0.1)
-    def update_panel(self):
+        return self.project_files[path]
+
+    def draw_panel(self):
+        with self.tracer.span('ui-update', target='panel'):
+            self.render_panel()
+
+    def render_panel(self):
         #self.logger.debug(' |- updating report panel')
-        window = sublime.active_window()
+        if not TestRunner.owns_panel(self):
+            return
 
-        try:
-            result_panel = window.create_output_panel('test_runner')
-        except:
-            result_panel = window.get_output_panel('test_runner')
+        window = self.window
+        result_panel = output_panel(window, 'test_runner')
 
         result_panel.set_syntax_file('Packages/Test Runner/TestRunnerOutput.tmLanguage')
 
-        result_panel.run_command(
-            'update_panel',
-            {'message': self.result['message']}
-        )
+        reset = (self.lines_rendered == 0)
+        message = self.pending_message()
+        if reset:
+            result_panel.settings().set('test_runner_panel', True)
+        if message or reset:
+            self.tracer.count('panel redraws')
+            result_panel.run_command('update_panel', {
+                'message': message,
+                'reset': reset,
+                'max_lines': settings.get('panel_max_lines', 0),
+                'last_line': self.lines_rendered
+            })
 
         if (self.result['failed'] > 0 or
                 settings.get('show_panel_default', False)):
@@ -327,39 +1086,246 @@ class TestRunnerWorker(threading.Thread):
         elif self.result['status'] == 'executed':
             window.run_command('hide_panel', {'panel': 'output.test_runner'})
 
-        if self.is_alive():
-            self.update_panel()
+    def clear_markers(self):
+        for view in self.window.views():
+            path = view.file_name()
+            if path and path.startswith(self.working_directory):
+                view.erase_regions('test_runner_failures')
+
+    def draw_markers(self):
+        changed = self.locations.take_changed()
+        for view in self.window.views():
+            if view.file_name() in changed:
+                draw_failure_markers(view, self.locations)
 
-    @throttle(1)
     def check_timeout(self):
-        current_time = time.time()
-        elapsed_time = current_time - self.start_time
+        if self.is_alive() and not self.finished:
+            self.logger.debug(' |- testing thread timed out after %d seconds', self.timeout)
+            self.timed_out = True
+            self.stop()
+            self.update_status()
 
-        if self.is_alive():
-            self.logger.debug(' |- testing thread running for %d seconds' % elapsed_time)
+def output_panel(window, name):
+    """Returns the output panel of a window, creating it when missing: as
+    creating a panel clears it, an existing one is always looked up first."""
+    find_output_panel = getattr(window, 'find_output_panel', None)
+    panel = find_output_panel(name) if find_output_panel else None
+    if panel is None:
+        try:
+            panel = window.create_output_panel(name)
+        except:
+            # Sublime Text 2 has no create_output_panel
+            panel = window.get_output_panel(name)
 
-        if elapsed_time > self.timeout:
-            self.logger.debug(' |- testing thread timed out')
-            self.stop()
+    return panel
+
+
+def draw_failure_markers(view, index):
+    regions = [
+        view.line(view.text_point(line - 1, 0))
+        for line in index.file_lines(view.file_name())
+    ]
+    view.add_regions('test_runner_failures', regions, 'test.status.fail', 'circle',
+                     sublime.HIDDEN | sublime.PERSISTENT)
+
+
+def draw_coverage_marks(view, index):
+    lines = index.uncovered(view.file_name())
+    if lines is None:
+        view.erase_regions('test_runner_coverage')
+        return
+
+    regions = [view.line(view.text_point(line - 1, 0)) for line in lines]
+    view.add_regions('test_runner_coverage', regions, 'test.coverage.uncovered', 'dot',
+                     sublime.HIDDEN | sublime.PERSISTENT)
+
+
+class ShowSlowestTestsCommand(sublime_plugin.WindowCommand):
+    description = 'Shows the slowest tests of the last run.'
+
+    def run(self, count=20):
+        initialize()
+        worker = TestRunner.worker_for(self.window)
+        if not worker or not len(worker.tests):
+            sublime.status_message('Test Runner: no test results to show')
+            return
+
+        timings = timing_history(worker.working_directory)
+        items = []
+        if len(timings.runs) > 1:
+            previous = timings.runs[:-1]
+            average = sum(run['duration'] for run in previous) / len(previous)
+            items.append([
+                'Suite: {0:.0f} ms'.format(timings.runs[-1]['duration']),
+                'average {0:.0f} ms over the previous {1} runs'.format(average, len(previous))
+            ])
+
+        for test in worker.tests.slowest(count):
+            entry = timings.get(test.description)
+            average = ''
+            if entry and entry['runs'] > 1:
+                average = 'average {0:.0f} ms over {1} runs'.format(entry['average'], entry['runs'])
+
+            items.append([
+                '{0:.0f} ms  [{1}] {2}'.format(test.duration, test.status, test.description),
+                average
+            ])
+
+        self.window.show_quick_panel(items, lambda index: None)
+
+
+class ShowFlakyTestsCommand(sublime_plugin.WindowCommand):
+    description = 'Shows the tests flipping between passing and failing across runs.'
+
+    def run(self, runs=20, count=20):
+        initialize()
+        worker = TestRunner.worker_for(self.window)
+        view = self.window.active_view()
+        if worker:
+            working_directory = worker.working_directory
+        elif view and view.file_name():
+            working_directory = project_directory(view.file_name())
+        else:
+            working_directory = None
+
+        flaky = working_directory and run_log(working_directory).flaky(runs, count)
+        if not flaky:
+            sublime.status_message('Test Runner: no flaky tests in the last %d runs' % runs)
+            return
+
+        items = []
+        for summary in flaky:
+            parts = ['flaky {0:.0%}'.format(summary['flake_score'])]
+            if summary['pass_rate'] is not None:
+                parts.append('pass rate {0:.0%}'.format(summary['pass_rate']))
+            older, newer = summary['trend']
+            if older is not None and newer is not None:
+                parts.append('{0:.0%} -> {1:.0%}'.format(older, newer))
+            if summary['duration_regression'] is not None:
+                parts.append('duration x{0:.1f}'.format(summary['duration_regression']))
 
-        if self.is_alive():
-            self.check_timeout()
+            items.append([summary['description'], ' | '.join(parts)])
+
+        self.window.show_quick_panel(items, lambda index: None)
+
+
+class ShowFailuresCommand(sublime_plugin.WindowCommand):
+    description = 'Shows the details of a failed test of the last run.'
+
+    def run(self):
+        initialize()
+        worker = TestRunner.worker_for(self.window)
+        failures = worker and worker.tests.failed()
+        if not failures:
+            sublime.status_message('Test Runner: no failures to show')
+            return
+
+        def on_done(selected):
+            if selected < 0:
+                return
+
+            failure = failures[selected]
+            panel = output_panel(self.window, 'test_runner_failure')
+
+            panel.run_command('update_panel', {
+                'message': details.describe(failure.description, worker.tests.failure(failure.index)),
+                'reset': True
+            })
+            self.window.run_command('show_panel', {'panel': 'output.test_runner_failure'})
+
+        self.window.show_quick_panel([failure.description for failure in failures], on_done)
 
 
 class UpdatePanelCommand(sublime_plugin.TextCommand):
     description = 'Updates panel with test results.'
 
-    def run(self, edit, message, *args, **kwargs):
+    def run(self, edit, message, reset=False, max_lines=0, last_line=None, *args, **kwargs):
         #print('UpdatePanelCommand.run', args, kwargs)
         #logger.debug('UpdatePanelCommand was triggered with arguments: %s' % (kwargs))
 
-        self.view.erase(edit, sublime.Region(0, self.view.size()))
+        if reset:
+            self.view.erase(edit, sublime.Region(0, self.view.size()))
+
         self.view.insert(edit, self.view.size(), message)
 
+        if max_lines:
+            lines, _ = self.view.rowcol(self.view.size())
+            if lines > max_lines:
+                trim_point = self.view.text_point(lines - max_lines, 0)
+                self.view.erase(edit, sublime.Region(0, trim_point))
+
+        if last_line is not None:
+            self.view.settings().set('test_runner_last_line', last_line)
+
         self.view.show(self.view.size())
 
 
+class GotoFailureCommand(sublime_plugin.TextCommand):
+    description = 'Opens the location of the failure on a line of the output panel.'
+
+    def run(self, edit, point=None):
+        window = self.view.window() or sublime.active_window()
+        worker = TestRunner.panel_owners.get(window.id())
+        if not worker:
+            return
+
+        if point is None:
+            point = self.view.sel()[0].begin()
+
+        # the panel only keeps its last lines, ending at test_runner_last_line
+        row, _ = self.view.rowcol(point)
+        rows, _ = self.view.rowcol(self.view.size())
+        panel_line = self.view.settings().get('test_runner_last_line', rows) - rows + row
+
+        location = worker.locations.location(panel_line)
+        if location:
+            window.open_file('%s:%d:%d' % location, sublime.ENCODED_POSITION)
+
+
+class FailureLocationListener(sublime_plugin.EventListener):
+    """Jumps to failures on double-click in the output panel, and draws
+    failure markers on source files opened after a run."""
+
+    def on_text_command(self, view, command_name, args):
+        if command_name != 'drag_select' or not args or args.get('by') != 'words':
+            return
+        if not view.settings().get('test_runner_panel'):
+            return
+
+        event = args.get('event')
+        if event:
+            view.run_command('goto_failure', {'point': view.window_to_text((event['x'], event['y']))})
+        else:
+            view.run_command('goto_failure')
+
+    def on_load(self, view):
+        if not initialized or not view.file_name():
+            return
+
+        worker = TestRunner.workers.get(project_directory(view.file_name()))
+        if worker and worker.locations.file_lines(view.file_name()):
+            draw_failure_markers(view, worker.locations)
+
+
+class CoverageListener(sublime_plugin.EventListener):
+    """Draws uncovered line marks from the coverage index of the project,
+    the reports are only read again after a coverage run."""
+
+    def on_activated(self, view):
+        if not initialized or not view.file_name():
+            return
+
+        index = coverage.indexes.get(project_directory(view.file_name()))
+        if index:
+            draw_coverage_marks(view, index)
+
+
 class PostSaveListener(sublime_plugin.EventListener):
+    """Triggers test runs on save, debounced per project: saves within
+    test_debounce_ms of each other result in a single run."""
+
+    pending = {}
+
     def on_post_save(self, view):
         #print('PostSaveListener.on_post_save')
         logger.debug('PostSaveListener was triggered')
@@ -368,9 +1334,39 @@ class PostSaveListener(sublime_plugin.EventListener):
             logger.debug(' |- testing on save is disabled')
             return
 
-        if settings.get('test_with_coverage_default', False):
+        initialize()
+        key = project_directory(view.file_name()) or view.file_name()
+        worker = TestRunner.workers.get(key)
+        if worker and worker.watch and worker.is_running():
+            # the watcher reruns the tests by itself
+            worker.mark_stale()
+            return
+
+        generation, paths = self.pending.get(key, (0, []))
+        generation += 1
+        paths = paths + [view.file_name()]
+        self.pending[key] = (generation, paths)
+
+        delay = settings.get_number('test_debounce_ms', 250)
+        logger.debug(' |- debouncing run for "%s" (%d saves)', key, len(paths))
+        sublime.set_timeout(lambda: self.trigger(view, key, generation), delay)
+
+    def trigger(self, view, key, generation):
+        pending_generation, paths = self.pending.get(key, (0, []))
+        if pending_generation != generation:
+            return
+
+        del self.pending[key]
+
+        if settings.get('test_watch', False, view):
+            logger.debug(' |- triggering [Run Tests] (watch mode)')
+            view.run_command('run_tests')
+        elif settings.get('test_with_coverage_default', False):
             logger.debug(' |- triggering [Run Tests with coverage] (enabled on settings)')
             view.run_command('run_tests', {'with_coverage': True})
+        elif settings.get('test_affected_only', False):
+            logger.debug(' |- triggering [Run affected tests] (enabled on settings)')
+            view.run_command('run_tests', {'affected': True, 'paths': paths})
         else:
             logger.debug(' |- triggering [Run Tests]')
             view.run_command('run_tests')
@@ -379,6 +1375,13 @@ logger.debug('< loading python file "%s"', __name__)
 
 
 settings = Settings()
+initialized = False
+project_directories = None
+fingerprints = None
+results = None
+daemons = None
+timing_histories = {}
+run_logs = {}
 st_version = 2
 package_name = 'Test Runner'
 
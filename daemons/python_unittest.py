@@ -0,0 +1,136 @@
+"""Reference test daemon for Python unittest suites.
+
+Test Runner sends every run to the stdin of its daemon as a JSON line,
+{"id": 1, "command": "...", "directory": "..."}, and reads TAP from its
+stdout up to a "# test-runner-daemon done <id>" line.
+
+This daemon imports the modules named on its command line once, then forks
+a child for every run, so each run starts from warm imports without
+sharing any state with the previous ones (where there is no fork, runs
+share the daemon process). The command of a run is a list of unittest
+names (tests.test_parser, tests.test_parser.ParserTest.test_plan) or of
+directories to discover tests in. Copy it to the project and set:
+
+    "test_daemon": true,
+    "test_daemon_command": "python daemons/python_unittest.py myproject",
+    "test_command": "tests"
+"""
+import os
+import sys
+import json
+import unittest
+
+DONE = '# test-runner-daemon done'
+
+
+class TapResult(unittest.TestResult):
+    """Writes test results as TAP 13 as they come."""
+
+    def __init__(self, stream):
+        unittest.TestResult.__init__(self)
+        self.stream = stream
+        self.number = 0
+
+    def report(self, status, test, directive=None, detail=None):
+        self.number += 1
+        line = '%s %d - %s' % (status, self.number, test.id())
+        if directive:
+            line += ' # ' + directive
+        self.stream.write(line + '\n')
+
+        if detail:
+            self.stream.write('  ---\n  message: |\n')
+            for detail_line in detail.rstrip().splitlines():
+                self.stream.write('    ' + detail_line + '\n')
+            self.stream.write('  ...\n')
+
+        self.stream.flush()
+
+    def addSuccess(self, test):
+        unittest.TestResult.addSuccess(self, test)
+        self.report('ok', test)
+
+    def addFailure(self, test, err):
+        unittest.TestResult.addFailure(self, test, err)
+        self.report('not ok', test, detail=self.failures[-1][1])
+
+    def addError(self, test, err):
+        unittest.TestResult.addError(self, test, err)
+        self.report('not ok', test, detail=self.errors[-1][1])
+
+    def addSkip(self, test, reason):
+        unittest.TestResult.addSkip(self, test, reason)
+        self.report('ok', test, directive='SKIP ' + reason)
+
+    def addExpectedFailure(self, test, err):
+        unittest.TestResult.addExpectedFailure(self, test, err)
+        self.report('not ok', test, directive='TODO expected failure')
+
+    def addUnexpectedSuccess(self, test):
+        unittest.TestResult.addUnexpectedSuccess(self, test)
+        self.report('not ok', test, detail='unexpected success')
+
+
+def load(names):
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    for name in names:
+        if os.path.isdir(name):
+            suite.addTests(loader.discover(name, top_level_dir='.'))
+        else:
+            suite.addTests(loader.loadTestsFromName(name))
+
+    return suite
+
+
+def run(request):
+    stdout = sys.stdout
+    stdout.write('TAP version 13\n')
+
+    os.chdir(request['directory'])
+    sys.path.insert(0, request['directory'])
+    try:
+        suite = load(request['command'].split())
+    except Exception:
+        import traceback
+        stdout.write('1..1\n')
+        TapResult(stdout).report('not ok', unittest.FunctionTestCase(lambda: None, description='loading tests'),
+                                 detail=traceback.format_exc())
+        return
+
+    stdout.write('1..%d\n' % suite.countTestCases())
+    suite.run(TapResult(stdout))
+
+
+def serve():
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+
+        request = json.loads(line)
+        if hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    # the requests are for the daemon only
+                    sys.stdin = open(os.devnull)
+                    os.dup2(sys.stdin.fileno(), 0)
+                    run(request)
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(0)
+
+            os.waitpid(pid, 0)
+        else:
+            run(request)
+
+        sys.stdout.write('%s %d\n' % (DONE, request['id']))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    for module in sys.argv[1:]:
+        __import__(module)
+
+    serve()
@@ -0,0 +1,239 @@
+import os
+import re
+import threading
+import collections
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+IGNORED_DIRECTORIES = set([
+    '.git', '.hg', '.svn', 'node_modules', 'bower_components', '__pycache__',
+    '.tox', '.nox', '.venv', 'venv', 'build', 'dist', 'coverage'
+])
+
+JS_EXTENSIONS = ('.js', '.jsx', '.mjs', '.cjs', '.ts', '.tsx')
+PY_EXTENSIONS = ('.py',)
+
+JS_IMPORT = re.compile(r'''
+    (?:\brequire\s*\(\s*|\bimport\s*\(\s*|\bfrom\s+|^\s*import\s+)
+    ['"](?P<specifier>[^'"]+)['"]
+''', re.X | re.M)
+
+PY_IMPORT = re.compile(r'''
+    ^[ \t]*(?:from[ \t]+(?P<from>\.*[\w.]*)[ \t]+import[ \t]+(?P<names>[\w \t,.*()]+)
+             |import[ \t]+(?P<modules>[\w \t,.]+))
+''', re.X | re.M)
+
+
+def relative_path(root, path):
+    return os.path.relpath(path, root).replace(os.path.sep, '/')
+
+
+class DependencyIndex():
+    """Reverse import graph of a project, mapping each file to the files
+    importing it. Built once by scanning the project on a background
+    thread, as that reads every source file, then kept up to date by
+    rescanning files as they are saved."""
+
+    def __init__(self, root):
+        self.root = root
+        self.imports = {}
+        self.importers = collections.defaultdict(set)
+        self.built = False
+        self.building = False
+        # files saved while the index is being built
+        self.changed = set()
+        self.lock = threading.Lock()
+
+    def file_changed(self, path):
+        """Rescans a saved file, or starts building the index when it is not
+        built yet. Returns whether the index is ready to be used."""
+        with self.lock:
+            built = self.built
+            if not built:
+                self.changed.add(path)
+                if not self.building:
+                    self.building = True
+                    thread = threading.Thread(target=self.build)
+                    thread.daemon = True
+                    thread.start()
+
+        if built:
+            self.update(path)
+
+        return built
+
+    def build(self):
+        logger.debug('building dependency index for "%s"', self.root)
+        for directory, directories, filenames in os.walk(self.root):
+            directories[:] = [d for d in directories if d not in IGNORED_DIRECTORIES]
+            for filename in filenames:
+                if filename.endswith(JS_EXTENSIONS + PY_EXTENSIONS):
+                    self.update(os.path.join(directory, filename))
+
+        # saved files may have been scanned before they changed
+        while True:
+            with self.lock:
+                changed, self.changed = self.changed, set()
+                if not changed:
+                    self.built = True
+                    self.building = False
+                    break
+
+            for path in changed:
+                self.update(path)
+
+        logger.debug('indexed imports of %d files', len(self.imports))
+
+    def update(self, path):
+        try:
+            with open(path, 'rb') as source:
+                content = source.read().decode('utf-8', 'replace')
+        except (IOError, OSError):
+            # deleted files are only removed from the index
+            targets = None
+        else:
+            if path.endswith(PY_EXTENSIONS):
+                targets = self.python_imports(path, content)
+            else:
+                targets = self.javascript_imports(path, content)
+
+        with self.lock:
+            for target in self.imports.pop(path, ()):
+                self.importers[target].discard(path)
+
+            if targets is not None:
+                self.imports[path] = targets
+                for target in targets:
+                    self.importers[target].add(path)
+
+    def dependents(self, path):
+        """Returns every file depending on path, directly or not."""
+        seen = set()
+        pending = [path]
+        with self.lock:
+            while pending:
+                for importer in self.importers.get(pending.pop(), ()):
+                    if importer not in seen:
+                        seen.add(importer)
+                        pending.append(importer)
+
+        return seen
+
+    def javascript_imports(self, path, content):
+        targets = set()
+        directory = os.path.dirname(path)
+        for match in JS_IMPORT.finditer(content):
+            specifier = match.group('specifier')
+            if specifier.startswith('.'):
+                target = self.resolve(os.path.join(directory, specifier), JS_EXTENSIONS)
+                if target:
+                    targets.add(target)
+
+        return targets
+
+    def python_imports(self, path, content):
+        modules = []
+        for match in PY_IMPORT.finditer(content):
+            if match.group('modules'):
+                modules.extend(m.strip() for m in match.group('modules').split(','))
+            else:
+                base = match.group('from')
+                names = match.group('names').replace('(', ' ').replace(')', ' ')
+                modules.append(base)
+                modules.extend(
+                    base + ('' if base.endswith('.') else '.') + n.strip()
+                    for n in names.split(',') if n.strip() not in ('', '*')
+                )
+
+        targets = set()
+        for module in modules:
+            module = module.split(' ')[0]
+            level = len(module) - len(module.lstrip('.'))
+            parts = [p for p in module.lstrip('.').split('.') if p]
+            if level:
+                base = os.path.dirname(path)
+                for _ in range(level - 1):
+                    base = os.path.dirname(base)
+                bases = [base]
+            else:
+                bases = [self.root, os.path.dirname(path)]
+
+            for base in bases:
+                target = self.resolve(os.path.join(base, *parts), PY_EXTENSIONS, '__init__')
+                if target:
+                    targets.add(target)
+                    break
+
+        return targets
+
+    def resolve(self, path, extensions, index='index'):
+        path = os.path.normpath(path)
+        candidates = [path] + [path + e for e in extensions]
+        candidates += [os.path.join(path, index + e) for e in extensions]
+        for candidate in candidates:
+            if candidate in self.imports or os.path.isfile(candidate):
+                return candidate
+
+
+class AffectedTests():
+    """Maps saved files to the test files covering them, using naming
+    conventions and, optionally, the project dependency index."""
+
+    def __init__(self, root, conventions, test_pattern, use_index=False):
+        self.root = root
+        self.conventions = [
+            (re.compile(c['source']), c.get('tests', []))
+            for c in conventions
+        ]
+        self.test_pattern = re.compile(test_pattern)
+        self.index = DependencyIndex(root) if use_index else None
+
+    def is_test(self, path):
+        return bool(self.test_pattern.search(relative_path(self.root, path)))
+
+    def find(self, path):
+        """Returns the relative paths of the existing test files affected
+        by a change to path."""
+        path = os.path.normpath(path)
+        affected = set()
+
+        if self.is_test(path):
+            affected.add(path)
+
+        relative = relative_path(self.root, path)
+        for source, tests in self.conventions:
+            match = source.search(relative)
+            if match:
+                for test in tests:
+                    candidate = os.path.join(self.root, match.expand(test))
+                    if os.path.isfile(candidate):
+                        affected.add(os.path.normpath(candidate))
+
+        if self.index is not None:
+            if self.index.file_changed(path):
+                for dependent in self.index.dependents(path):
+                    if self.is_test(dependent):
+                        affected.add(dependent)
+            else:
+                logger.debug('dependency index of "%s" is not built yet, using naming conventions', self.root)
+
+        return sorted(relative_path(self.root, p) for p in affected)
+
+
+projects = {}
+
+
+def affected_tests(root, path, conventions, test_pattern, use_index=False):
+    key = (root, repr(conventions), test_pattern, use_index)
+    if key not in projects:
+        projects[key] = AffectedTests(root, conventions, test_pattern, use_index)
+
+    return projects[key].find(path)
+
+logger.debug('< loading python file "%s"', __name__)
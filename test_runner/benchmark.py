@@ -0,0 +1,463 @@
+"""Headless benchmarks of the plugin overhead.
+
+Feeds synthetic TAP streams through parsers.TapParser, the
+TestRunnerWorker event handlers and the output panel rendering, with stub
+sublime modules, and reports lines/sec, peak memory and per-line latency.
+The plugin startup time (loading TestRunner.py and plugin_loaded()) is
+measured in fresh interpreters.
+
+Usage, from the package directory:
+
+    python -m test_runner.benchmark [--sizes 1000,10000] [--output result.json]
+                                    [--baseline baseline.json] [--tolerance 0.1]
+"""
+import os
+import sys
+import gc
+import json
+import time
+import types
+import tempfile
+import argparse
+import importlib
+import subprocess
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE_NAME = 'TestRunnerBenchmark'
+
+SIZES = (1000, 10000, 100000)
+KINDS = ('plain', 'yaml', 'comments', 'stderr')
+STARTUP_RUNS = 7
+
+# startup times are a few milliseconds, so timer and scheduler noise alone
+# would exceed the relative tolerance
+STARTUP_SLACK_MS = 2.0
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class StubSettings(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def add_on_change(self, key, on_change):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
+class StubRegion():
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+
+class StubView():
+    commands = {}
+
+    def __init__(self, file_name=None):
+        self.text = ''
+        self.path = file_name
+        self.view_settings = StubSettings()
+
+    def file_name(self):
+        return self.path
+
+    def window(self):
+        return stub_window
+
+    def settings(self):
+        return self.view_settings
+
+    def set_status(self, key, value):
+        pass
+
+    def size(self):
+        return len(self.text)
+
+    def erase(self, edit, region):
+        self.text = self.text[:region.begin()] + self.text[region.end():]
+
+    def insert(self, edit, point, text):
+        self.text = self.text[:point] + text + self.text[point:]
+        return len(text)
+
+    def rowcol(self, point):
+        text = self.text[:point]
+        return (text.count('\n'), point - text.rfind('\n') - 1)
+
+    def text_point(self, row, col):
+        point = 0
+        for _ in range(row):
+            point = self.text.index('\n', point) + 1
+        return point + col
+
+    def show(self, *args):
+        pass
+
+    def set_syntax_file(self, syntax_file):
+        pass
+
+    def run_command(self, name, args=None):
+        self.commands[name](self).run(None, **(args or {}))
+
+
+class StubWindow():
+    def __init__(self):
+        self.panels = {}
+
+    def create_output_panel(self, name):
+        # like Sublime Text, creating a panel clears an existing one
+        panel = self.panels[name] = StubView()
+        return panel
+
+    get_output_panel = create_output_panel
+
+    def find_output_panel(self, name):
+        return self.panels.get(name)
+
+    def id(self):
+        return id(self)
+
+    def views(self):
+        return []
+
+    def run_command(self, name, args=None):
+        pass
+
+
+stub_window = StubWindow()
+
+
+def stub_modules(settings):
+    """Installs stub sublime and sublime_plugin modules."""
+    sublime = types.ModuleType('sublime')
+    sublime.Region = StubRegion
+    sublime.version = lambda: '3211'
+    sublime.set_timeout = lambda fn, delay=0: None
+    sublime.load_settings = lambda name: settings
+    sublime.active_window = lambda: stub_window
+    sublime.windows = lambda: [stub_window]
+    sublime.status_message = lambda message: None
+    cache_directory = tempfile.mkdtemp(prefix='test-runner-benchmark-')
+    sublime.cache_path = lambda: cache_directory
+    sublime.installed_packages_path = lambda: cache_directory
+    sublime.packages_path = lambda: cache_directory
+
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    for name in ('TextCommand', 'WindowCommand', 'ApplicationCommand', 'EventListener'):
+        setattr(sublime_plugin, name, type(name, (object,), {
+            '__init__': lambda self, target=None: None
+        }))
+
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+
+
+def stub_package():
+    """Installs the stub sublime modules and the plugin package."""
+    with open(os.path.join(PACKAGE_DIRECTORY, 'TestRunner.sublime-settings')) as f:
+        settings = StubSettings(json.load(f))
+    stub_modules(settings)
+
+    package = types.ModuleType(PACKAGE_NAME)
+    package.__path__ = [PACKAGE_DIRECTORY]
+    sys.modules[PACKAGE_NAME] = package
+
+
+def load_plugin():
+    stub_package()
+    plugin = importlib.import_module(PACKAGE_NAME + '.TestRunner')
+    plugin.package_name = PACKAGE_NAME
+    # what the first run would do
+    plugin.initialize()
+    StubView.commands = {'update_panel': plugin.UpdatePanelCommand}
+
+    def init_command(self, view):
+        self.view = view
+    plugin.UpdatePanelCommand.__init__ = init_command
+
+    return plugin
+
+
+def startup():
+    """Loads the plugin the way Sublime Text does on startup, printing the
+    time it took and the modules it imported as JSON."""
+    stub_package()
+    modules = set(sys.modules)
+    start = clock()
+    plugin = importlib.import_module(PACKAGE_NAME + '.TestRunner')
+    plugin.plugin_loaded()
+    elapsed = clock() - start
+
+    print(json.dumps({
+        'startup_ms': 1e3 * elapsed,
+        'imported_modules': len(set(sys.modules) - modules)
+    }))
+
+
+def bench_startup(runs=STARTUP_RUNS):
+    """Returns the median startup metrics of fresh interpreters, as the
+    plugin modules are only loaded once per process."""
+    code = 'import sys; sys.path.insert(0, %r); from test_runner import benchmark; benchmark.startup()' % PACKAGE_DIRECTORY
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=PACKAGE_DIRECTORY)
+        samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    samples.sort(key=lambda sample: sample['startup_ms'])
+    return samples[len(samples) // 2]
+
+
+def synthetic_tap(kind, size):
+    """Returns a list of (stream, line) tuples of a synthetic run."""
+    lines = [('stdout', 'TAP version 13\n'), ('stdout', '1..%d\n' % size)]
+    for number in range(1, size + 1):
+        failed = (number % 10 == 0)
+        lines.append(('stdout', '%s %d - suite %d should do thing number %d\n' % (
+            'not ok' if failed else 'ok', number, number // 100, number)))
+
+        if kind == 'yaml' and (failed or number % 2 == 0):
+            lines.extend(('stdout', line) for line in (
+                '  ---\n',
+                '  message: expected values to be equal\n',
+                '  severity: fail\n',
+                '  duration_ms: %d\n' % (number % 50),
+                '  at: lib/module_%d.js:%d:%d\n' % (number % 7, number % 300, number % 40),
+                '  expected: %d\n' % number,
+                '  actual: %d\n' % (number + 1),
+                '  ...\n'
+            ))
+        elif kind == 'comments':
+            lines.append(('stdout', '# suite %d, case %d\n' % (number // 100, number)))
+            lines.append(('stdout', '#   with some more detail\n'))
+        elif kind == 'stderr':
+            lines.append(('stderr', '(node:1234) DeprecationWarning: something %d is deprecated\n' % number))
+
+    return lines
+
+
+def measure(create_run, lines):
+    """Feeds all lines to a run(stream, line) function from create_run,
+    returning timing and memory metrics. Memory is measured on a second
+    pass, so tracing does not skew the timings."""
+    run = create_run()
+    gc.collect()
+
+    latencies = []
+    start = clock()
+    for stream, line in lines:
+        line_start = clock()
+        run(stream, line)
+        latencies.append(clock() - line_start)
+    elapsed = clock() - start
+
+    peak_memory = None
+    if tracemalloc:
+        run = None
+        gc.collect()
+        tracemalloc.start()
+        run = create_run()
+        for stream, line in lines:
+            run(stream, line)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'lines': len(lines),
+        'seconds': elapsed,
+        'lines_per_sec': len(lines) / elapsed if elapsed else 0,
+        'latency_p50_us': 1e6 * latencies[len(latencies) // 2],
+        'latency_p99_us': 1e6 * latencies[int(len(latencies) * 0.99)],
+        'latency_max_us': 1e6 * latencies[-1],
+        'peak_memory_bytes': peak_memory
+    }
+
+
+def bench_parser(plugin, lines):
+    def create_run():
+        tapParser = plugin.parsers.TapParser()
+        lineParser = plugin.parsers.LineParser()
+        feeds = {'stdout': tapParser.feed, 'stderr': lineParser.feed}
+
+        def run(stream, line):
+            feeds[stream](line)
+
+        return run
+
+    return measure(create_run, lines)
+
+
+class BenchmarkWorker(object):
+    """Mixin creating a worker without its thread."""
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return True
+
+
+def create_worker(plugin):
+    worker_class = type('Worker', (BenchmarkWorker, plugin.TestRunnerWorker), {})
+    view = StubView(os.path.join(PACKAGE_DIRECTORY, 'TestRunner.py'))
+
+    worker = worker_class(view, PACKAGE_DIRECTORY, 'true')
+    plugin.TestRunner.panel_owners[stub_window.id()] = worker
+
+    return worker
+
+
+def bench_worker(plugin, lines):
+    def create_run():
+        worker = create_worker(plugin)
+        tapParser, lineParser = worker.create_parsers()
+        feeds = {'stdout': tapParser.feed, 'stderr': lineParser.feed}
+
+        def run(stream, line):
+            worker.line_time = clock()
+            feeds[stream](line)
+
+        return run
+
+    return measure(create_run, lines)
+
+
+def bench_panel(plugin, lines, batch=100):
+    def create_run():
+        worker = create_worker(plugin)
+        tapParser, lineParser = worker.create_parsers()
+        feeds = {'stdout': tapParser.feed, 'stderr': lineParser.feed}
+        counter = {'lines': 0}
+
+        def run(stream, line):
+            worker.line_time = clock()
+            feeds[stream](line)
+            counter['lines'] += 1
+            if counter['lines'] % batch == 0:
+                worker.draw_panel()
+
+        return run
+
+    return measure(create_run, lines)
+
+
+BENCHMARKS = (
+    ('parser', bench_parser),
+    ('worker', bench_worker),
+    ('panel', bench_panel)
+)
+
+
+def run_benchmarks(sizes, kinds):
+    results = {'startup': bench_startup()}
+    print('{0:<24} {1:>9.2f} ms  {2} modules imported'.format(
+        'startup', results['startup']['startup_ms'], results['startup']['imported_modules']))
+
+    plugin = load_plugin()
+    for kind in kinds:
+        for size in sizes:
+            lines = synthetic_tap(kind, size)
+            for name, benchmark in BENCHMARKS:
+                key = '%s.%s.%d' % (name, kind, size)
+                results[key] = benchmark(plugin, lines)
+                report(key, results[key])
+
+    return results
+
+
+def report(key, metrics):
+    memory = metrics['peak_memory_bytes']
+    print('{0:<24} {1:>12.0f} lines/s  p50 {2:>7.1f} us  p99 {3:>7.1f} us  peak {4}'.format(
+        key,
+        metrics['lines_per_sec'],
+        metrics['latency_p50_us'],
+        metrics['latency_p99_us'],
+        '%.1f MiB' % (memory / 1048576.0) if memory is not None else 'n/a'
+    ))
+
+
+def compare(results, baseline, tolerance):
+    """Returns the descriptions of the metrics that regressed by more than
+    tolerance against baseline."""
+    regressions = []
+    for key, metrics in sorted(results.items()):
+        if key not in baseline:
+            continue
+
+        base = baseline[key]
+        if key == 'startup':
+            limit = base['startup_ms'] * (1 + tolerance) + STARTUP_SLACK_MS
+            checks = (
+                ('startup_ms', limit, metrics['startup_ms'] > limit),
+                ('imported_modules', base['imported_modules'], metrics['imported_modules'] > base['imported_modules'])
+            )
+        else:
+            checks = (
+                ('lines_per_sec', base['lines_per_sec'] * (1 - tolerance), metrics['lines_per_sec'] < base['lines_per_sec'] * (1 - tolerance)),
+                ('latency_p99_us', base['latency_p99_us'] * (1 + tolerance), metrics['latency_p99_us'] > base['latency_p99_us'] * (1 + tolerance))
+            )
+            if base.get('peak_memory_bytes') and metrics.get('peak_memory_bytes'):
+                limit = base['peak_memory_bytes'] * (1 + tolerance)
+                checks += (('peak_memory_bytes', limit, metrics['peak_memory_bytes'] > limit),)
+
+        for metric, limit, regressed in checks:
+            if regressed:
+                regressions.append('%s %s: %.1f (limit %.1f, baseline %.1f)' % (
+                    key, metric, metrics[metric], limit, base[metric]))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the Test Runner plugin overhead.')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+        help='comma separated test case counts (default: %(default)s)')
+    parser.add_argument('--kinds', default=','.join(KINDS),
+        help='comma separated stream kinds (default: %(default)s)')
+    parser.add_argument('--output', help='writes the results as JSON to this file')
+    parser.add_argument('--baseline', help='compares the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='allowed relative regression against the baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        [int(size) for size in args.sizes.split(',')],
+        args.kinds.split(',')
+    )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
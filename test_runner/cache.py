@@ -0,0 +1,139 @@
+import os
+import json
+import fnmatch
+import hashlib
+import threading
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+from .affected import IGNORED_DIRECTORIES
+
+
+class ProjectFingerprint():
+    """Content hash of the files of a project.
+
+    File digests are memoized by (mtime, size), so only files touched since
+    the previous fingerprint are read again."""
+
+    def __init__(self, ignore=()):
+        self.ignore = list(ignore)
+        self.digests = {}
+
+    def compute(self, root, *extra):
+        fingerprint = hashlib.sha1()
+        for value in extra:
+            fingerprint.update(repr(value).encode('utf-8'))
+
+        for path in self.files(root):
+            digest = self.digest(path)
+            if digest:
+                fingerprint.update(os.path.relpath(path, root).encode('utf-8'))
+                fingerprint.update(digest)
+
+        return fingerprint.hexdigest()
+
+    def files(self, root):
+        paths = []
+        for directory, directories, filenames in os.walk(root):
+            directories[:] = [d for d in directories if d not in IGNORED_DIRECTORIES]
+            for filename in filenames:
+                if not any(fnmatch.fnmatch(filename, p) for p in self.ignore):
+                    paths.append(os.path.join(directory, filename))
+
+        return sorted(paths)
+
+    def digest(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        stamp = (stat.st_mtime, stat.st_size)
+        memo = self.digests.get(path)
+        if memo and memo[0] == stamp:
+            return memo[1]
+
+        digest = hashlib.sha1()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    digest.update(chunk)
+        except (IOError, OSError):
+            return None
+
+        self.digests[path] = (stamp, digest.digest())
+        return digest.digest()
+
+
+class ResultCache():
+    """LRU cache of run results, persisted as JSON at path."""
+
+    def __init__(self, path, size=32):
+        self.path = path
+        self.size = size
+        self.entries = None
+        # least recently used first (no OrderedDict on Python 2.6)
+        self.keys = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.entries is not None:
+            return
+
+        self.entries = {}
+        self.keys = []
+        try:
+            with open(self.path, 'r') as f:
+                for key, value in json.load(f):
+                    if key not in self.entries:
+                        self.keys.append(key)
+                    self.entries[key] = value
+        except (IOError, OSError, ValueError):
+            pass
+
+    def touch(self, key):
+        if key in self.entries:
+            self.keys.remove(key)
+        self.keys.append(key)
+
+    def get(self, key):
+        with self.lock:
+            self.load()
+            value = self.entries.get(key)
+            if value is not None:
+                self.touch(key)
+
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.load()
+            self.touch(key)
+            self.entries[key] = value
+            while len(self.keys) > self.size:
+                del self.entries[self.keys.pop(0)]
+
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            temporary_path = self.path + '.tmp'
+            with open(temporary_path, 'w') as f:
+                json.dump([(key, self.entries[key]) for key in self.keys], f)
+
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temporary_path, self.path)
+        except (IOError, OSError):
+            logger.exception('could not save result cache to "%s"', self.path)
+
+logger.debug('< loading python file "%s"', __name__)
@@ -0,0 +1,223 @@
+import os
+import threading
+from xml.parsers import expat
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class LineBitmap():
+    """Set of line numbers stored as one bit per line."""
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, line):
+        byte = line >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(byte - len(self.bits) + 1))
+        self.bits[byte] |= 1 << (line & 7)
+
+    def __contains__(self, line):
+        byte = line >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (line & 7)))
+
+    def __iter__(self):
+        for byte, bits in enumerate(self.bits):
+            if bits:
+                for bit in range(8):
+                    if bits & (1 << bit):
+                        yield (byte << 3) | bit
+
+
+class FileCoverage():
+    def __init__(self):
+        self.lines = LineBitmap()
+        self.covered = LineBitmap()
+
+    def hit(self, line, hits):
+        self.lines.add(line)
+        if hits:
+            self.covered.add(line)
+
+    def uncovered(self):
+        covered = self.covered
+        return [line for line in self.lines if line not in covered]
+
+
+def parse_lcov(path, add):
+    """Streams an lcov tracefile, calling add(file, line, hits) for every
+    DA record."""
+    source = None
+    with open(path) as f:
+        for line in f:
+            if line.startswith('DA:'):
+                if source:
+                    fields = line[3:].split(',')
+                    try:
+                        add(source, int(fields[0]), int(float(fields[1])))
+                    except (IndexError, ValueError):
+                        pass
+            elif line.startswith('SF:'):
+                source = line[3:].strip()
+            elif line.startswith('end_of_record'):
+                source = None
+
+
+def parse_cobertura(path, add, sources):
+    """Streams a Cobertura XML report, calling add(file, line, hits) for
+    every line of its classes and appending its source roots to sources."""
+    state = {'source': None, 'text': None}
+
+    def start_element(name, attributes):
+        if name == 'source':
+            state['text'] = []
+        elif name == 'class':
+            state['source'] = attributes.get('filename')
+        elif name == 'line' and state['source']:
+            try:
+                add(state['source'], int(attributes['number']), int(float(attributes.get('hits', 0))))
+            except (KeyError, ValueError):
+                pass
+
+    def end_element(name):
+        if name == 'source':
+            sources.append(''.join(state['text']).strip())
+            state['text'] = None
+        elif name == 'class':
+            state['source'] = None
+
+    def character_data(data):
+        if state['text'] is not None:
+            state['text'].append(data)
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    with open(path, 'rb') as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            parser.Parse(chunk, False)
+            chunk = f.read(CHUNK_SIZE)
+        parser.Parse(b'', True)
+
+
+class CoverageIndex():
+    """Covered lines of a project, read from its lcov or Cobertura reports.
+
+    Reports are streamed into a bitmap of instrumented and covered lines per
+    file, and only read again once their mtime changed. A file changed after
+    the reports were written has no coverage, as its lines moved."""
+
+    def __init__(self, root, reports=()):
+        self.root = root
+        self.reports = list(reports)
+        self.stamps = None
+        self.report_time = 0
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def report_stamps(self):
+        stamps = []
+        for report in self.reports:
+            try:
+                stamps.append((report, os.stat(os.path.join(self.root, report)).st_mtime))
+            except OSError:
+                pass
+
+        return stamps
+
+    def refresh(self):
+        """Reads the reports again if any of them changed, returning whether
+        the index changed."""
+        stamps = self.report_stamps()
+        if stamps == self.stamps:
+            return False
+
+        files = {}
+        for report, stamp in stamps:
+            path = os.path.join(self.root, report)
+            logger.debug('reading coverage report "%s"', path)
+            try:
+                self.read(path, files)
+            except (IOError, OSError, expat.ExpatError):
+                logger.exception('Could not read coverage report "%s"', path)
+
+        with self.lock:
+            self.files = files
+            self.stamps = stamps
+            self.report_time = max([stamp for report, stamp in stamps] or [0])
+
+        return True
+
+    def read(self, path, files):
+        resolved = {}
+        # Cobertura <source> roots come before the classes using them
+        sources = []
+        roots = [os.path.dirname(path), self.root]
+
+        def add(source, line, hits):
+            if source not in resolved:
+                resolved[source] = self.resolve(source, sources + roots)
+            coverage = files.get(resolved[source])
+            if coverage is None:
+                coverage = files[resolved[source]] = FileCoverage()
+            coverage.hit(line, hits)
+
+        if path.endswith('.xml'):
+            parse_cobertura(path, add, sources)
+        else:
+            parse_lcov(path, add)
+
+    def resolve(self, source, roots):
+        if os.path.isabs(source):
+            return os.path.normpath(source)
+
+        for root in roots:
+            candidate = os.path.normpath(os.path.join(root, source))
+            if os.path.isfile(candidate):
+                return candidate
+
+        return os.path.normpath(os.path.join(self.root, source))
+
+    def uncovered(self, path):
+        """Returns the uncovered lines of a file, or None when there is no
+        coverage for it."""
+        path = os.path.normpath(path)
+        with self.lock:
+            coverage = self.files.get(path)
+            report_time = self.report_time
+
+        if coverage is None:
+            return None
+
+        try:
+            if os.stat(path).st_mtime > report_time:
+                return None
+        except OSError:
+            return None
+
+        return coverage.uncovered()
+
+
+indexes = {}
+
+
+def coverage_index(root, reports):
+    """Returns the (cached) coverage index of a project."""
+    index = indexes.get(root)
+    if index is None or index.reports != list(reports):
+        index = indexes[root] = CoverageIndex(root, reports)
+
+    return index
+
+logger.debug('< loading python file "%s"', __name__)
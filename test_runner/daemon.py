@@ -0,0 +1,202 @@
+import os
+import json
+import threading
+import subprocess
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+from .process import group_options, terminate_group
+
+
+DONE = '# test-runner-daemon done'
+
+
+class DaemonStream():
+    """Read side of a daemon stream for a single request, readline()
+    returns '' once the request is done."""
+
+    def __init__(self):
+        self.lines = queue.Queue()
+
+    def put(self, line):
+        self.lines.put(line)
+
+    def close(self):
+        self.lines.put('')
+
+    def readline(self):
+        return self.lines.get()
+
+
+class Daemon():
+    """Long-lived process running test requests for a project.
+
+    Each request is written to the daemon stdin as a JSON line with "id",
+    "command" and "directory" keys. The daemon answers with TAP on stdout
+    and ends the request with a "# test-runner-daemon done <id>" line."""
+
+    def __init__(self, command, directory, watch=()):
+        self.command = command
+        self.directory = directory
+        self.watch = list(watch)
+        self.stamps = self.watch_stamps()
+        self.process = None
+        self.streams = None
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.idle_timer = None
+
+    def start(self):
+        logger.debug('starting daemon "%s" in "%s"', self.command, self.directory)
+        self.process = subprocess.Popen(
+            self.command,
+            shell=True,
+            cwd=self.directory,
+            universal_newlines=True,
+            bufsize=1,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **group_options()
+        )
+
+        for name, stream in (('stdout', self.process.stdout), ('stderr', self.process.stderr)):
+            reader = threading.Thread(target=self.read_stream, args=(name, stream))
+            reader.daemon = True
+            reader.start()
+
+    def stop(self):
+        self.cancel_idle_timer()
+        if self.process and self.process.poll() is None:
+            logger.debug('stopping daemon "%s"', self.command)
+            terminate_group(self.process)
+
+        self.finish()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def is_busy(self):
+        return self.streams is not None
+
+    def is_stale(self):
+        return self.watch_stamps() != self.stamps
+
+    def watch_stamps(self):
+        stamps = []
+        for filename in self.watch:
+            try:
+                stamps.append(os.stat(os.path.join(self.directory, filename)).st_mtime)
+            except OSError:
+                stamps.append(None)
+
+        return stamps
+
+    def request(self, command):
+        """Sends a run request, returning the (stdout, stderr) streams of
+        its output."""
+        self.cancel_idle_timer()
+        with self.lock:
+            self.requests += 1
+            self.streams = (DaemonStream(), DaemonStream())
+            streams = self.streams
+
+        self.process.stdin.write(json.dumps({
+            'id': self.requests,
+            'command': command,
+            'directory': self.directory
+        }) + '\n')
+        self.process.stdin.flush()
+
+        return streams
+
+    def read_stream(self, name, stream):
+        for line in iter(stream.readline, ''):
+            with self.lock:
+                streams = self.streams
+
+            if name == 'stdout' and line.startswith(DONE):
+                self.finish()
+            elif streams is None:
+                logger.debug('daemon %s outside of a request: %s', name, line.rstrip())
+            else:
+                streams[0 if name == 'stdout' else 1].put(line)
+
+        if name == 'stdout':
+            self.finish()
+
+    def finish(self):
+        with self.lock:
+            streams, self.streams = self.streams, None
+
+        if streams:
+            for stream in streams:
+                stream.close()
+
+    def schedule_idle_timeout(self, timeout, on_idle):
+        self.cancel_idle_timer()
+        self.idle_timer = threading.Timer(timeout, on_idle, args=(self,))
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def cancel_idle_timer(self):
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+
+class DaemonPool():
+    """Keeps one warm daemon per project directory, restarting it when it
+    died, is busy or any of its watched files changed, and reaping it after
+    idle_timeout seconds without requests."""
+
+    def __init__(self, idle_timeout=300):
+        self.idle_timeout = idle_timeout
+        self.daemons = {}
+        self.lock = threading.Lock()
+
+    def get(self, command, directory, watch=()):
+        with self.lock:
+            daemon = self.daemons.get(directory)
+            if daemon and (daemon.command != command or daemon.watch != list(watch) or
+                    not daemon.is_alive() or daemon.is_busy() or daemon.is_stale()):
+                logger.debug('restarting daemon for "%s"', directory)
+                daemon.stop()
+                daemon = None
+
+            if daemon is None:
+                daemon = Daemon(command, directory, watch)
+                daemon.start()
+                self.daemons[directory] = daemon
+
+        return daemon
+
+    def release(self, daemon):
+        if self.idle_timeout:
+            daemon.schedule_idle_timeout(self.idle_timeout, self.reap)
+
+    def reap(self, daemon):
+        with self.lock:
+            if self.daemons.get(daemon.directory) is daemon and not daemon.is_busy():
+                logger.debug('reaping idle daemon for "%s"', daemon.directory)
+                del self.daemons[daemon.directory]
+                daemon.stop()
+
+    def stop(self):
+        with self.lock:
+            for daemon in self.daemons.values():
+                daemon.stop()
+
+            self.daemons.clear()
+
+logger.debug('< loading python file "%s"', __name__)
@@ -1,4 +1,6 @@
 import time
+import threading
+import collections
 import sublime
 
 import logging
@@ -11,7 +13,7 @@ logger.debug('> loading python file "%s"', __name__)
 class LazyDecorator():
     def __init__(self, seconds, limit):
         self.last_time = time.time() - seconds
-        self.queue = []
+        self.queue = collections.deque()
         self.processing_queue = False
         self.seconds = seconds
         self.limit = limit
@@ -41,7 +43,7 @@ class LazyDecorator():
             wait_ms = 0
 
         try:
-            (fn, params) = self.queue.pop(0)
+            (fn, params) = self.queue.popleft()
             self.processing_queue = True
             sublime.set_timeout(lambda: self.call_now(fn, *params), wait_ms)
         except IndexError:
@@ -53,6 +55,107 @@ class ThrottleDecorator(LazyDecorator):
         LazyDecorator.__init__(self, seconds, 1)
 
 
+class Scheduler():
+    """Coalescing refresh loop, meant to be owned by a single worker.
+
+    Tasks are marked dirty with mark() from any thread and run on the next
+    tick, at most once per their interval, no matter how many times they
+    were marked in between. Periodic tasks run every interval while
+    is_active() holds. The loop only schedules ticks while there is
+    something to run and stops once the owner is no longer active."""
+
+    def __init__(self, fps, is_active):
+        self.frame = 1.0 / fps
+        self.is_active = is_active
+        # tasks run in the order they were added (no OrderedDict on Python 2.6)
+        self.tasks = {}
+        self.order = []
+        self.dirty = set()
+        self.running = False
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.counters = {
+            'dispatched': 0,
+            'coalesced': 0,
+            'dropped': 0
+        }
+
+    def add(self, name, fn, interval=0, periodic=False):
+        if name not in self.tasks:
+            self.order.append(name)
+        self.tasks[name] = {
+            'fn': fn,
+            'interval': max(interval, self.frame),
+            'periodic': periodic,
+            'last_time': 0
+        }
+
+    def mark(self, name):
+        with self.lock:
+            if self.stopped:
+                self.counters['dropped'] += 1
+                return
+
+            if name in self.dirty:
+                self.counters['coalesced'] += 1
+                return
+
+            self.dirty.add(name)
+            if self.running:
+                return
+
+            self.running = True
+
+        self.schedule(0)
+
+    def stop(self):
+        """Stops the loop, dropping any pending task."""
+        with self.lock:
+            self.stopped = True
+            self.counters['dropped'] += len(self.dirty)
+            self.dirty.clear()
+
+    def schedule(self, delay):
+        sublime.set_timeout(self.tick, int(1000 * delay))
+
+    def tick(self):
+        now = time.time()
+        active = self.is_active()
+
+        with self.lock:
+            if self.stopped:
+                self.running = False
+                return
+
+            due = []
+            for name in self.order:
+                task = self.tasks[name]
+                if now - task['last_time'] < task['interval']:
+                    continue
+                if name in self.dirty:
+                    self.dirty.discard(name)
+                elif not (task['periodic'] and active):
+                    continue
+                due.append(task)
+
+        for task in due:
+            task['last_time'] = now
+            self.counters['dispatched'] += 1
+            task['fn']()
+
+        with self.lock:
+            delays = [
+                self.tasks[name]['last_time'] + self.tasks[name]['interval'] - now
+                for name in self.order
+                if name in self.dirty or (self.tasks[name]['periodic'] and active)
+            ]
+            if not delays or self.stopped:
+                self.running = False
+                return
+
+        self.schedule(max(min(delays), self.frame))
+
+
 def lazy(seconds, limit):
     """Lazy policy, will queue up to {limit} executions and wait {seconds} milliseconds for each one."""
     decorator = LazyDecorator(seconds, limit)
@@ -0,0 +1,147 @@
+import re
+import json
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+KEY_VALUE = re.compile(r'^(?P<key>[^\s:#][^:#]*?)\s*:(?:\s+(?P<value>.*?))?\s*$')
+BLOCK_SCALAR = re.compile(r'^(?P<style>[|>])[-+]?\d*$')
+
+# TAP producers do not agree on the names of the compared values
+ALIASES = {
+    'expected': ('expected', 'wanted'),
+    'actual': ('actual', 'found')
+}
+
+
+def indentation(line):
+    return len(line) - len(line.lstrip(' '))
+
+
+def dedent(lines):
+    significant = [indentation(line) for line in lines if line.strip()]
+    margin = min(significant) if significant else 0
+
+    return [line[margin:] for line in lines]
+
+
+def scalar(value):
+    """Converts a plain, quoted or flow YAML scalar to a Python value."""
+    if value in ('~', 'null', 'Null', 'NULL'):
+        return None
+    if value in ('true', 'True', 'TRUE'):
+        return True
+    if value in ('false', 'False', 'FALSE'):
+        return False
+
+    if value[:1] == "'" and value[-1:] == "'" and len(value) > 1:
+        return value[1:-1].replace("''", "'")
+
+    if value[:1] in '"[{-0123456789':
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def parse(text):
+    """Parses the subset of YAML used by TAP 13 diagnostics: mappings of
+    plain, quoted and block scalars, nested mappings and sequences of
+    scalars. Anything else is kept as its dedented text."""
+    lines = [line.rstrip() for line in text.splitlines()]
+    lines = [line for line in lines if not line.lstrip().startswith('#')]
+    lines = dedent(lines)
+
+    if any(line.startswith('- ') or line == '-' for line in lines):
+        return [scalar(line[1:].strip()) for line in lines if line.startswith('-')]
+
+    data = {}
+    position = 0
+    while position < len(lines):
+        line = lines[position]
+        position += 1
+
+        match = KEY_VALUE.match(line)
+        if not match:
+            continue
+
+        block = []
+        while position < len(lines) and (not lines[position] or lines[position][0] == ' '):
+            block.append(lines[position])
+            position += 1
+
+        while block and not block[-1]:
+            block.pop()
+
+        key, value = match.group('key'), match.group('value') or ''
+        style = BLOCK_SCALAR.match(value)
+        if style:
+            block = dedent(block)
+            data[key] = (' ' if style.group('style') == '>' else '\n').join(block)
+        elif value:
+            data[key] = scalar(value)
+        elif block:
+            data[key] = parse('\n'.join(block))
+        else:
+            data[key] = None
+
+    return data
+
+
+def failure(text):
+    """Returns the message, severity, at, expected and actual fields of a
+    YAML detail block (None when missing), along with all of its data."""
+    try:
+        data = parse(text or '')
+    except Exception:
+        logger.exception('Could not parse test case detail')
+        data = {}
+
+    if not isinstance(data, dict):
+        data = {'actual': data}
+
+    result = {'data': data}
+    for field in ('message', 'severity', 'at', 'expected', 'actual'):
+        result[field] = None
+        for key in ALIASES.get(field, (field,)):
+            if key in data:
+                result[field] = data[key]
+                break
+
+    return result
+
+
+def format_value(value):
+    if isinstance(value, dict):
+        return '\n'.join('%s: %s' % (key, format_value(value[key])) for key in sorted(value))
+    if isinstance(value, list):
+        return '\n'.join('- %s' % format_value(item) for item in value)
+
+    return '%s' % value
+
+
+def describe(description, detail):
+    """Returns the text shown when a failure, as returned by failure(), is
+    opened."""
+    lines = ['[FAIL] %s' % description]
+    for field in ('message', 'severity', 'at', 'expected', 'actual'):
+        if detail[field] is None:
+            continue
+
+        value = format_value(detail[field])
+        if '\n' in value:
+            lines.append('%s:' % field)
+            lines.extend('    ' + line for line in value.splitlines())
+        else:
+            lines.append('%s: %s' % (field, value))
+
+    return '\n'.join(lines) + '\n'
+
+logger.debug('< loading python file "%s"', __name__)
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import struct
+import threading
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+from .results import STATUSES, STATUS_CODES
+
+
+class TimingHistory():
+    """Per-project summary of previous runs, persisted as JSON at path.
+
+    Keeps, for each test description, the last status and duration and a
+    moving average of its duration, plus the totals of the last runs."""
+
+    def __init__(self, path, runs=50, smoothing=0.3):
+        self.path = path
+        self.max_runs = runs
+        self.smoothing = smoothing
+        self.tests = {}
+        self.runs = []
+        # workers of the same project can finish at the same time
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.tests = data.get('tests', {})
+            self.runs = data.get('runs', [])
+        except (IOError, OSError, ValueError):
+            pass
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            with self.lock:
+                with open(self.path, 'w') as f:
+                    json.dump({'tests': self.tests, 'runs': self.runs}, f)
+        except (IOError, OSError):
+            logger.exception('could not save timing history to "%s"', self.path)
+
+    def get(self, description):
+        return self.tests.get(description)
+
+    def has_failed(self, description):
+        entry = self.tests.get(description)
+        return entry is not None and entry.get('status') == 'FAIL'
+
+    def prioritized(self):
+        """Returns the known test descriptions, the ones that failed on
+        their last run first, then from the fastest to the slowest."""
+        with self.lock:
+            return sorted(
+                self.tests,
+                key=lambda description: (
+                    self.tests[description].get('status') != 'FAIL',
+                    self.tests[description]['average']
+                )
+            )
+
+    def record(self, tests, duration):
+        """Adds the records of a finished run."""
+        with self.lock:
+            for test in tests:
+                entry = self.tests.get(test.description)
+                if entry is None:
+                    entry = self.tests[test.description] = {'average': test.duration, 'runs': 0}
+
+                entry['average'] += self.smoothing * (test.duration - entry['average'])
+                entry['duration'] = test.duration
+                entry['status'] = test.status
+                entry['runs'] += 1
+
+            self.runs.append({
+                'time': time.time(),
+                'duration': duration,
+                'tests': len(tests),
+                'failed': len(tests.failed())
+            })
+            del self.runs[:-self.max_runs]
+
+        self.save()
+
+# run number, test id, status code, duration (ms)
+RECORD = struct.Struct('<IIBf')
+CHUNK_RECORDS = 4096
+
+
+def flake_score(statuses):
+    """Returns how often a test flipped between PASS and FAIL from one run
+    to the next, from 0 (never) to 1 (every run)."""
+    statuses = [status for status in statuses if status in ('PASS', 'FAIL')]
+    if len(statuses) < 2:
+        return 0.0
+
+    flips = sum(1 for previous, status in zip(statuses, statuses[1:]) if previous != status)
+    return flips / float(len(statuses) - 1)
+
+
+def pass_rate(statuses):
+    statuses = [status for status in statuses if status in ('PASS', 'FAIL')]
+    if not statuses:
+        return None
+
+    return statuses.count('PASS') / float(len(statuses))
+
+
+def duration_regression(durations, recent=3):
+    """Returns the mean of the most recent durations relative to the
+    median of the earlier ones (1.0 means no change), or None without
+    enough runs."""
+    if len(durations) < recent + 3:
+        return None
+
+    earlier = sorted(durations[:-recent])
+    median = earlier[len(earlier) // 2]
+    if median <= 0:
+        return None
+
+    return sum(durations[-recent:]) / float(recent) / median
+
+
+class RunLog():
+    """Append-only per-project log of test results, persisted at path.
+
+    Each test of a run is a fixed size record, tests are referenced by the
+    line of their description in a names file next to the log, which is
+    the only part held in memory. Queries read the log backwards from its
+    end, only as far as the runs they look at."""
+
+    def __init__(self, path):
+        self.path = path
+        self.names_path = os.path.splitext(path)[0] + '.names'
+        self.ids = {}
+        self.names = []
+        self.last_run = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.names_path, 'rb') as f:
+                for line in f:
+                    name = line.decode('utf-8').rstrip('\n')
+                    self.ids[name] = len(self.names)
+                    self.names.append(name)
+        except (IOError, OSError):
+            pass
+
+        try:
+            with open(self.path, 'r+b') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size % RECORD.size:
+                    # a run interrupted while being written
+                    size -= size % RECORD.size
+                    f.truncate(size)
+                if size:
+                    f.seek(size - RECORD.size)
+                    self.last_run = RECORD.unpack(f.read(RECORD.size))[0]
+        except (IOError, OSError):
+            pass
+
+    def append(self, tests):
+        """Appends the records of a finished run."""
+        with self.lock:
+            run = self.last_run + 1
+            names = []
+            records = []
+            for test in tests:
+                name = test.description.replace('\n', ' ')
+                test_id = self.ids.get(name)
+                if test_id is None:
+                    test_id = self.ids[name] = len(self.names)
+                    self.names.append(name)
+                    names.append(name)
+                records.append(RECORD.pack(run, test_id, STATUS_CODES[test.status], test.duration))
+
+            directory = os.path.dirname(self.path)
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+                if names:
+                    with open(self.names_path, 'ab') as f:
+                        f.write(''.join(name + '\n' for name in names).encode('utf-8'))
+                with open(self.path, 'ab') as f:
+                    f.write(b''.join(records))
+                self.last_run = run
+            except (IOError, OSError):
+                logger.exception('could not append run to "%s"', self.path)
+
+    def tail(self, runs):
+        """Yields the (run, test id, status code, duration) records of the
+        last runs, newest first."""
+        first_run = self.last_run - runs + 1
+        try:
+            f = open(self.path, 'rb')
+        except (IOError, OSError):
+            return
+
+        with f:
+            end = os.fstat(f.fileno()).st_size // RECORD.size * RECORD.size
+            while end > 0:
+                start = max(0, end - CHUNK_RECORDS * RECORD.size)
+                f.seek(start)
+                data = f.read(end - start)
+                for offset in range(len(data) - RECORD.size, -1, -RECORD.size):
+                    record = RECORD.unpack_from(data, offset)
+                    if record[0] < first_run:
+                        return
+                    yield record
+                end = start
+
+    def results(self, description, runs=20):
+        """Returns the (status, duration) of a test in the last runs, from
+        the oldest to the newest."""
+        test_id = self.ids.get(description)
+        if test_id is None:
+            return []
+
+        found = [
+            (STATUSES[status], duration)
+            for run, record_id, status, duration in self.tail(runs)
+            if record_id == test_id
+        ]
+        found.reverse()
+
+        return found
+
+    def summary(self, description, results):
+        statuses = [status for status, duration in results]
+        half = len(statuses) // 2
+
+        return {
+            'description': description,
+            'runs': len(results),
+            'flake_score': flake_score(statuses),
+            'pass_rate': pass_rate(statuses),
+            'trend': (pass_rate(statuses[:half]), pass_rate(statuses[half:])),
+            'duration_regression': duration_regression([duration for status, duration in results])
+        }
+
+    def test_summary(self, description, runs=20):
+        """Returns the flake score, pass rate, pass rate trend (older and
+        newer half of the runs) and duration regression of a test."""
+        return self.summary(description, self.results(description, runs))
+
+    def flaky(self, runs=20, limit=20):
+        """Returns the summaries of the flakiest tests of the last runs."""
+        results = {}
+        for run, test_id, status, duration in self.tail(runs):
+            results.setdefault(test_id, []).append((STATUSES[status], duration))
+
+        summaries = []
+        for test_id, test_results in results.items():
+            test_results.reverse()
+            name = self.names[test_id] if test_id < len(self.names) else '#%d' % test_id
+            summary = self.summary(name, test_results)
+            if summary['flake_score'] > 0:
+                summaries.append(summary)
+
+        summaries.sort(key=lambda summary: (-summary['flake_score'], summary['description']))
+        return summaries[:limit]
+
+logger.debug('< loading python file "%s"', __name__)
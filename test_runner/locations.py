@@ -0,0 +1,128 @@
+import os
+import re
+import threading
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+# "at foo (src/a.js:12:5)", "src/a.js:12", 'File "src/a.py", line 12'
+STACK_FRAME = re.compile(r'''
+    (?<!\w)(?P<file>(?:[A-Za-z]:)?[\w./\\~@+-]*\w\.\w+)
+    (?::|",[ ]line[ ])(?P<line>\d+)(?::(?P<column>\d+))?
+    ''', re.X)
+
+YAML_AT = re.compile(r'^(?P<indent>[ \t]*)at:(?P<value>.*)$', re.M)
+AT_FILE = re.compile(r'''\bfile:[ \t]*['"]?(?P<file>[^'",}\s]+)''')
+AT_LINE = re.compile(r'\bline:[ \t]*(?P<line>\d+)')
+AT_COLUMN = re.compile(r'\bcolumn:[ \t]*(?P<column>\d+)')
+
+IGNORED_PATHS = ('node_modules', 'site-packages')
+
+# stack traces mostly end in framework code, nobody wants markers for it all
+MAX_LOCATIONS = 5
+
+
+def frames(text):
+    """Returns the (file, line, column) locations of a stack trace."""
+    return [
+        (match.group('file'), int(match.group('line')), int(match.group('column') or 0))
+        for match in STACK_FRAME.finditer(text)
+    ]
+
+
+def from_yaml(yaml):
+    """Returns the locations of a TAP 13 YAML block, from its "at" field
+    first and then from any stack trace in it."""
+    locations = []
+    match = YAML_AT.search(yaml)
+    if match:
+        if match.group('value').strip():
+            at = match.group('value')
+        else:
+            # a nested mapping, up to the next line that is not indented deeper
+            indent = len(match.group('indent'))
+            lines = []
+            for line in yaml[match.end():].splitlines()[1:]:
+                if line.strip() and len(line) - len(line.lstrip()) <= indent:
+                    break
+                lines.append(line)
+            at = '\n'.join(lines)
+
+        file_match = AT_FILE.search(at)
+        line_match = AT_LINE.search(at)
+        if file_match and line_match:
+            column_match = AT_COLUMN.search(at)
+            locations.append((
+                file_match.group('file'),
+                int(line_match.group('line')),
+                int(column_match.group('column')) if column_match else 0
+            ))
+        else:
+            locations.extend(frames(at))
+
+    locations.extend(frames(yaml))
+    return locations
+
+
+class LocationIndex():
+    """Failure locations of a run, keyed by output panel line and by source
+    file. It is filled from the worker thread as results stream in, and the
+    files changed since the last take_changed() are redrawn by the UI."""
+
+    def __init__(self, root):
+        self.root = root
+        self.lines = {}
+        self.files = {}
+        self.changed = set()
+        self.exists = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, path):
+        """Returns the absolute path of a project file, or None."""
+        if path not in self.exists:
+            absolute = os.path.normpath(os.path.join(self.root, path))
+            parts = absolute.split(os.sep)
+            if any(ignored in parts for ignored in IGNORED_PATHS) or not os.path.isfile(absolute):
+                absolute = None
+            self.exists[path] = absolute
+
+        return self.exists[path]
+
+    def add(self, panel_line, description, locations):
+        with self.lock:
+            known = self.lines.setdefault(panel_line, [])
+            for path, line, column in locations:
+                if len(known) >= MAX_LOCATIONS:
+                    break
+
+                path = self.resolve(path)
+                if path is None or (path, line, column) in known:
+                    continue
+
+                known.append((path, line, column))
+                self.files.setdefault(path, {}).setdefault(line, []).append(description)
+                self.changed.add(path)
+
+    def location(self, panel_line):
+        """Returns the first (file, line, column) of a panel line, or None."""
+        with self.lock:
+            locations = self.lines.get(panel_line)
+            return locations[0] if locations else None
+
+    def file_lines(self, path):
+        """Returns the lines of a file with failure locations."""
+        with self.lock:
+            return sorted(self.files.get(path, ()))
+
+    def take_changed(self):
+        with self.lock:
+            changed, self.changed = self.changed, set()
+
+        return changed
+
+logger.debug('< loading python file "%s"', __name__)
@@ -0,0 +1,83 @@
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+if hasattr(logging.handlers, 'QueueHandler'):
+    QueueHandler = logging.handlers.QueueHandler
+    QueueListener = logging.handlers.QueueListener
+else:
+    # Python 2 has no queue handlers, these are minimal versions of them
+    class QueueHandler(logging.Handler):
+        def __init__(self, records):
+            logging.Handler.__init__(self)
+            self.queue = records
+
+        def emit(self, record):
+            try:
+                # formats now, so arguments are not held across threads
+                record.msg = self.format(record)
+                record.args = None
+                record.exc_info = None
+                self.queue.put_nowait(record)
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener():
+        sentinel = None
+
+        def __init__(self, records, *handlers):
+            self.queue = records
+            self.handlers = handlers
+            self.thread = None
+
+        def start(self):
+            self.thread = threading.Thread(target=self.monitor)
+            self.thread.daemon = True
+            self.thread.start()
+
+        def monitor(self):
+            while True:
+                record = self.queue.get()
+                if record is self.sentinel:
+                    break
+                for handler in self.handlers:
+                    handler.handle(record)
+
+        def stop(self):
+            self.queue.put_nowait(self.sentinel)
+            self.thread.join()
+            self.thread = None
+
+
+class BackgroundHandler(QueueHandler):
+    """Handler queueing records to be written by the given handler on a
+    background thread."""
+
+    def __init__(self, handler):
+        records = queue.Queue()
+        QueueHandler.__init__(self, records)
+        self.listener = QueueListener(records, handler)
+        self.listener.start()
+
+    def close(self):
+        if self.listener:
+            self.listener.stop()
+            # the wrapped handlers hold the log file open
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+
+        QueueHandler.close(self)
+
+logger.debug('< loading python file "%s"', __name__)
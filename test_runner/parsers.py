@@ -1,4 +1,6 @@
 import re
+import json
+from xml.parsers import expat
 
 import logging
 import logging.handlers
@@ -7,8 +9,49 @@ logger = logging.getLogger(__name__)
 
 logger.debug('> loading python file "%s"', __name__)
 
+
+TAP_COMMENT = re.compile(r'^\s*\#(?P<comment>.+)\s*$', re.X | re.I)
+
+TAP_VERSION = re.compile(r'''^    \s*
+    TAP\s*version\s*(?P<version>\d+)   \s*
+    $''', re.X | re.I)
+
+TAP_PLAN = re.compile(r'''             \s*
+    (?P<start>\d+)..(?P<end>\d+)    \s*
+    $''', re.X | re.I)
+
+# plans end watch cycles, so they are matched strictly there ("2024" is no plan)
+WATCH_PLAN = re.compile(r'^\s*(?P<start>\d+)\.\.(?P<end>\d+)\s*$')
+
+TAP_TEST_CASE = re.compile(r'''^                                                                \s*
+    (?P<status>ok|not\sok)                                                              \s*
+    (?P<number>\d+)?                                                                    \s*
+    (?:-\s*)?(?P<description>.+?)                                                       \s*
+    (?:\#\s*(?:(?P<directive_type>TODO|SKIP)\s)?\s*(?P<directive_description>.*))?      \s*
+    $''', re.X | re.I)
+
+TAP_YAML_START = re.compile(r'\s*---\s*$', re.X | re.I)
+TAP_YAML_END = re.compile(r'^\s*\.\.\.\s*$', re.X | re.I)
+
+
 class TapParser():
-    def __init__(self, source):
+    """Single pass TAP 12/13 parser.
+
+    Lines are handled one at a time by a table of state handlers, a handler
+    returns True when it consumed the line or False when the line should be
+    handled again by the (new) current state. Regular expressions only run
+    when the first significant character of a line could start a match.
+    """
+
+    VERSION = 'version'
+    PLAN = 'plan'
+    TEST_CASE = 'test_case'
+    TEST_CASE_DETAIL = 'test_case_detail'
+    YAML = 'yaml'
+
+    PLAN_PATTERN = TAP_PLAN
+
+    def __init__(self, source=None):
         self.source = source
         self.signal = {
             'line': Signal(),
@@ -19,180 +62,617 @@ class TapParser():
             'test_case_detail': Signal(),
             'tests_completed': Signal()
         }
+        self.states = {
+            self.VERSION: self.parse_version,
+            self.PLAN: self.parse_tests_planned,
+            self.TEST_CASE: self.parse_test_case,
+            self.TEST_CASE_DETAIL: self.parse_test_case_detail,
+            self.YAML: self.parse_yaml
+        }
+        self.state = self.VERSION
+        self.comment = ''
+        self.yaml = []
+        self.yaml_indent = 0
+        self.test_number = 0
 
-    def advance(self):
-        if self.source is None:
-            return
+    def parse(self):
+        readline = self.source.readline
+        feed = self.feed
 
-        self.current_line = self.source.readline()
+        line = readline()
+        while line:
+            feed(line)
+            line = readline()
 
-        if len(self.current_line) > 0:
-            eof = False
-            self.signal['line'].dispatch(self.current_line)
-        else:
-            eof = True
+        self.close()
 
-        return (not eof)
+    def feed(self, line):
+        self.signal['line'].dispatch(line)
 
-    def parse(self):
-        self.advance()
-
-        self.parse_version()
-        self.parse_tests_planned()
-        ok = True
-        while ok:
-            test_case = self.parse_test_case()
-            if test_case:
-                self.parse_test_case_detail()
-            else:
-                ok = self.advance()
+        states = self.states
+        while not states[self.state](line):
+            pass
+
+    def close(self):
+        if self.state == self.YAML:
+            self.end_yaml()
 
+        self.flush_comment()
+
+        if self.state == self.VERSION:
+            self.version(12)
+
+        self.state = self.VERSION
+        self.test_number = 0
         self.signal['tests_completed'].dispatch()
 
-    def skip_empty(self):
-        regex = re.compile(r'^\s+$', re.X | re.I)
-        while regex.match(self.current_line):
-            self.advance()
+    def significant(self, line):
+        """Returns the first significant character of a line, collecting
+        comments and skipping empty lines along the way (None means the
+        line was consumed)."""
+        stripped = line.lstrip()
+        if not stripped:
+            return None
+
+        first = stripped[0]
+        if first == '#':
+            match = TAP_COMMENT.match(line)
+            if match:
+                self.comment += match.group('comment')
+                return None
+
+        self.flush_comment()
+        return first
+
+    def flush_comment(self):
+        if self.comment:
+            comment, self.comment = self.comment, ''
+            self.signal['comment'].dispatch(comment=comment)
+
+    def version(self, version):
+        self.state = self.PLAN
+        self.signal['version'].dispatch(version=version)
+
+    def parse_version(self, line):
+        first = self.significant(line)
+        if first is None:
+            return True
+
+        if first in 'tT':
+            match = TAP_VERSION.match(line)
+            if match:
+                self.version(int(match.group('version')))
+                return True
+
+        self.version(12)
+        return False
+
+    def parse_tests_planned(self, line):
+        first = self.significant(line)
+        if first is None:
+            return True
+
+        self.state = self.TEST_CASE
+        if first.isdigit():
+            match = self.PLAN_PATTERN.match(line)
+            if match:
+                self.signal['tests_planned'].dispatch(
+                    start=int(match.group('start')),
+                    end=int(match.group('end'))
+                )
+                return True
+
+        return False
+
+    def parse_test_case(self, line):
+        first = self.significant(line)
+        if first is None or first not in 'oOnN':
+            return True
+
+        match = TAP_TEST_CASE.match(line)
+        if not match:
+            return True
+
+        if match.group('number'):
+            self.test_number = int(match.group('number'))
+        else:
+            self.test_number += 1
+
+        directive_type = match.group('directive_type')
+        if directive_type:
+            directive_type = directive_type.upper()
+
+        self.state = self.TEST_CASE_DETAIL
+        self.signal['test_case'].dispatch(
+            status=(match.group('status').upper() == 'OK'),
+            number=self.test_number,
+            description=match.group('description'),
+            directive={
+                'type': directive_type,
+                'description': match.group('directive_description')
+            }
+        )
+        return True
+
+    def parse_test_case_detail(self, line):
+        first = self.significant(line)
+        if first is None:
+            return True
+
+        if first == '-' and TAP_YAML_START.match(line):
+            self.state = self.YAML
+            self.yaml = []
+            self.yaml_indent = len(line) - len(line.lstrip())
+            return True
+
+        self.state = self.TEST_CASE
+        return False
+
+    def parse_yaml(self, line):
+        stripped = line.lstrip()
+        if stripped[:3] == '...' and TAP_YAML_END.match(line):
+            self.end_yaml()
+            return True
+
+        # a block missing its end marker ends at the first outdented line
+        if stripped and len(line) - len(stripped) < self.yaml_indent:
+            self.end_yaml()
+            return False
+
+        self.yaml.append(line)
+        return True
+
+    def end_yaml(self):
+        self.state = self.TEST_CASE
+        yaml, self.yaml = self.yaml, []
+        if yaml:
+            self.signal['test_case_detail'].dispatch(yaml=''.join(yaml))
+
 
-    def parse_comments(self):
-        self.skip_empty()
+class WatchParser(TapParser):
+    """TAP parser for the continuous output of a test watcher.
 
-        regex = re.compile(r'^\s*\#(?P<comment>.+)\s*$', re.X | re.I)
+    Every rerun of the watcher is a cycle ending with tests_completed. A
+    cycle ends at a version line or plan line following its test cases (a
+    plan is taken as the trailing plan of a cycle that had none), or at the
+    first other output or comment once all of its planned test cases and
+    their YAML blocks were reported, as tape and node-tap end a run with
+    "# tests N" comments and then go idle."""
 
-        comment = ''
-        match = regex.match(self.current_line)
-        while match:
-            comment += match.group('comment')
-            self.advance()
-            self.skip_empty()
-            match = regex.match(self.current_line)
+    PLAN_PATTERN = WATCH_PLAN
 
-        if len(comment) > 0:
-            result = {'comment': comment}
-            self.signal['comment'].dispatch(**result)
-            return result
+    def __init__(self, source=None):
+        TapParser.__init__(self, source)
+        self.planned = None
+        self.tests_seen = False
+        self.signal['tests_planned'].add(self.plan_seen)
+        self.signal['test_case'].add(self.test_case_seen)
 
-    def parse_version(self):
-        self.parse_comments()
+    def plan_seen(self, start, end):
+        self.planned = end
 
-        regex = re.compile(r'''^    \s*
-            TAP\s*version\s*(?P<version>\d+)   \s*
-            $''', re.X | re.I)
+    def test_case_seen(self, **kwargs):
+        self.tests_seen = True
 
-        match = regex.match(self.current_line)
-        if match:
-            self.advance()
-            version = int(match.group('version'))
-        else:
-            version = 12
+    def close(self):
+        # the watcher exiting only completes a cycle that has output
+        if self.tests_seen or self.planned is not None:
+            self.end_cycle()
 
-        result = {'version': version}
-        self.signal['version'].dispatch(**result)
-        return result
+    def end_cycle(self):
+        TapParser.close(self)
+        self.planned = None
+        self.tests_seen = False
 
-    def parse_tests_planned(self):
-        self.parse_comments()
+    def cycle_done(self):
+        return self.tests_seen and self.planned is not None and self.test_number >= self.planned
 
-        regex = re.compile(r'''             \s*
-            (?P<start>\d+)..(?P<end>\d+)    \s*
-            $''', re.X | re.I)
+    def parse_version(self, line):
+        consumed = TapParser.parse_version(self, line)
+        if self.state == self.VERSION:
+            # comments between cycles belong to the completed one
+            self.flush_comment()
 
-        match = regex.match(self.current_line)
-        if match:
-            self.advance()
-            result = {
-                'start': int(match.group('start')),
-                'end': int(match.group('end'))
-            }
-            self.signal['tests_planned'].dispatch(**result)
-            return result
-
-    def parse_test_case(self):
-        self.parse_comments()
-
-        regex = re.compile(r'''^                                                                \s*
-            (?P<status>ok|not\sok)                                                              \s*
-            (?P<number>\d+)?                                                                    \s*
-            (?:-\s*)?(?P<description>.+?)                                                       \s*
-            (?:\#\s*(?:(?P<directive_type>TODO|SKIP)\s)?\s*(?P<directive_description>.*))?      \s*
-            $''', re.X | re.I)
-
-        def isok(s):
-            return (s.upper() == 'OK')
-
-        match = regex.match(self.current_line)
-        if match:
-            self.advance()
-            directive_type = None
-            if match.group('directive_type'):
-                directive_type = match.group('directive_type').upper()
-            result = {
-                'status': isok(match.group('status')),
-                'number': int(match.group('number')),
-                'description': match.group('description'),
-                'directive': {
-                    'type': directive_type,
-                    'description': match.group('directive_description')
-                }
-            }
-            self.signal['test_case'].dispatch(**result)
-            #time.sleep(1) # for the lulz
-            return result
+        return consumed
+
+    def parse_test_case_detail(self, line):
+        if line.lstrip()[:1] == '#' and self.cycle_done():
+            self.state = self.TEST_CASE
+            return False
+
+        return TapParser.parse_test_case_detail(self, line)
 
-    def parse_test_case_detail(self):
-        self.parse_comments()
+    def parse_test_case(self, line):
+        stripped = line.lstrip()
+        if not stripped:
+            return True
 
-        yaml_start = re.compile(r'\s*---\s*$', re.X | re.I)
-        yaml_end = re.compile(r'\s*...\s*$', re.X | re.I)
+        if stripped[0] == '#':
+            TapParser.parse_test_case(self, line)
+            if self.cycle_done():
+                self.end_cycle()
+            return True
 
-        yaml = ''
-        match = yaml_start.match(self.current_line)
-        if match:
-            self.advance()
-            while not yaml_end.match(self.current_line):
-                yaml += self.current_line
-                self.advance()
+        first = stripped[0]
+        if first in 'oOnN' and TAP_TEST_CASE.match(line):
+            return TapParser.parse_test_case(self, line)
 
-        if len(yaml) > 0:
-            result = {'yaml': yaml}
-            self.signal['test_case_detail'].dispatch(**result)
-            return result
+        if first in 'tT' and TAP_VERSION.match(line):
+            if not self.tests_seen:
+                return True
+
+            self.end_cycle()
+            return False
+
+        if first.isdigit() and WATCH_PLAN.match(line):
+            if not self.tests_seen:
+                # watchers may print a banner before the plan
+                if self.planned is None:
+                    TapParser.parse_tests_planned(self, line)
+                return True
+
+            if self.planned is None:
+                TapParser.parse_tests_planned(self, line)
+                self.end_cycle()
+                return True
+
+            self.end_cycle()
+            return False
+
+        if self.tests_seen and self.planned is not None and self.test_number >= self.planned:
+            self.end_cycle()
+            return False
+
+        return TapParser.parse_test_case(self, line)
 
 
 class LineParser():
-    def __init__(self, source):
+    def __init__(self, source=None):
         self.source = source
         self.signal = {
             'line': Signal(),
             'completed': Signal()
         }
 
-    def advance(self):
-        if self.source is None:
-            return
+    def parse(self):
+        readline = self.source.readline
+
+        line = readline()
+        while line:
+            self.feed(line)
+            line = readline()
+
+        self.close()
+
+    def feed(self, line):
+        self.signal['line'].dispatch(line)
+
+    def close(self):
+        self.signal['completed'].dispatch()
+
 
-        self.current_line = self.source.readline()
-        self.signal['line'].dispatch(self.current_line)
+def detail_yaml(**fields):
+    """Returns a TAP 13 YAML block body with the given fields, so every
+    parser reports test case details the same way."""
+    lines = []
+    for key in sorted(fields):
+        value = fields[key]
+        if value is None or value == '':
+            continue
 
-        return (not len(self.current_line) == 0)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append('  %s: %s\n' % (key, value))
+            continue
+
+        value = '%s' % value
+        if '\n' in value:
+            lines.append('  %s: |\n' % key)
+            lines.extend('    %s\n' % line for line in value.rstrip('\n').split('\n'))
+        else:
+            lines.append("  %s: '%s'\n" % (key, value.replace("'", "''")))
+
+    return ''.join(lines)
+
+
+class JUnitParser():
+    """Incremental JUnit XML parser.
+
+    Lines are fed to an expat parser as they arrive, test cases are reported
+    when their element ends and only the text of the current test case is
+    kept, so memory does not grow with the document. Anything before the
+    first element (build tool banners) is ignored."""
+
+    OUTCOMES = {
+        'failure': 'failure',
+        'error': 'error',
+        'skipped': 'SKIP'
+    }
+    TEXTS = ('failure', 'error', 'skipped', 'system-out', 'system-err')
+
+    def __init__(self, source=None):
+        self.source = source
+        self.signal = {
+            'line': Signal(),
+            'version': Signal(),
+            'comment': Signal(),
+            'tests_planned': Signal(),
+            'test_case': Signal(),
+            'test_case_detail': Signal(),
+            'tests_completed': Signal()
+        }
+        self.reset()
+
+    def reset(self):
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+        self.started = False
+        self.broken = False
+        self.planned = []
+        self.test = None
+        self.text = None
+        self.test_number = 0
 
     def parse(self):
-        self.advance()
+        readline = self.source.readline
+
+        line = readline()
+        while line:
+            self.feed(line)
+            line = readline()
+
+        self.close()
+
+    def feed(self, line):
+        self.signal['line'].dispatch(line)
+
+        if self.broken:
+            return
+
+        if not self.started:
+            if not line.lstrip().startswith('<'):
+                return
+            self.started = True
+
+        try:
+            self.parser.Parse(line, False)
+        except expat.ExpatError as error:
+            logger.debug('invalid JUnit XML, ignoring the rest of it: %s', error)
+            self.broken = True
+
+    def close(self):
+        if self.started and not self.broken:
+            try:
+                self.parser.Parse('', True)
+            except expat.ExpatError as error:
+                logger.debug('incomplete JUnit XML: %s', error)
+
+        self.reset()
+        self.signal['tests_completed'].dispatch()
+
+    def start_element(self, name, attributes):
+        if name in ('testsuites', 'testsuite'):
+            # only the outermost element with a test count is a plan
+            plan = 'tests' in attributes and True not in self.planned
+            self.planned.append(plan)
+            if plan:
+                self.signal['tests_planned'].dispatch(start=1, end=int(attributes['tests']))
+        elif name == 'testcase':
+            self.test = {
+                'description': ' '.join(
+                    part for part in (attributes.get('classname'), attributes.get('name')) if part
+                ),
+                'time': attributes.get('time'),
+                'outcome': None,
+                'message': None,
+                'output': []
+            }
+        elif self.test is not None and name in self.TEXTS:
+            if name in self.OUTCOMES:
+                self.test['outcome'] = self.OUTCOMES[name]
+                self.test['message'] = attributes.get('message')
+            self.text = []
+
+    def end_element(self, name):
+        if name in ('testsuites', 'testsuite'):
+            if self.planned:
+                self.planned.pop()
+        elif name == 'testcase' and self.test is not None:
+            self.end_test_case()
+        elif self.text is not None and name in self.TEXTS:
+            text = ''.join(self.text).strip()
+            if text:
+                self.test['output'].append(text)
+            self.text = None
+
+    def character_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def end_test_case(self):
+        test, self.test = self.test, None
+        self.test_number += 1
+
+        outcome = test['outcome']
+        self.signal['test_case'].dispatch(
+            status=outcome is None,
+            number=self.test_number,
+            description=test['description'],
+            directive={
+                'type': 'SKIP' if outcome == 'SKIP' else None,
+                'description': test['message'] if outcome == 'SKIP' else ''
+            }
+        )
 
-        while self.advance():
+        duration = None
+        try:
+            duration = 1000 * float(test['time'])
+        except (TypeError, ValueError):
             pass
 
-        self.signal['completed'].dispatch()
+        yaml = detail_yaml(
+            message=test['message'] if outcome != 'SKIP' else None,
+            severity=outcome if outcome != 'SKIP' else None,
+            stack='\n'.join(test['output']) if outcome in ('failure', 'error') else None,
+            duration_ms=duration
+        )
+        if yaml:
+            self.signal['test_case_detail'].dispatch(yaml=yaml)
+
+
+class JsonParser():
+    """Newline delimited JSON event parser.
+
+    Understands objects like {"type": "plan", "total": 2} and
+    {"type": "test", "name": "...", "status": "pass|fail|skip|todo",
+    "duration_ms": 1, "message": "...", "stack": "...", "at": "..."}, as well
+    as the ["start"|"pass"|"fail"|"pending", {...}] arrays of mocha's
+    json-stream reporter. Other lines are reported as comments."""
+
+    MOCHA_STATUSES = {
+        'pass': 'pass',
+        'fail': 'fail',
+        'pending': 'skip'
+    }
+
+    def __init__(self, source=None):
+        self.source = source
+        self.signal = {
+            'line': Signal(),
+            'version': Signal(),
+            'comment': Signal(),
+            'tests_planned': Signal(),
+            'test_case': Signal(),
+            'test_case_detail': Signal(),
+            'tests_completed': Signal()
+        }
+        self.test_number = 0
+
+    def parse(self):
+        readline = self.source.readline
+
+        line = readline()
+        while line:
+            self.feed(line)
+            line = readline()
+
+        self.close()
+
+    def feed(self, line):
+        self.signal['line'].dispatch(line)
+
+        stripped = line.strip()
+        if not stripped:
+            return
+
+        event = None
+        if stripped[0] in '{[':
+            try:
+                event = json.loads(stripped)
+            except ValueError:
+                pass
+
+        if isinstance(event, list) and len(event) == 2 and isinstance(event[1], dict):
+            self.mocha_event(event[0], event[1])
+        elif isinstance(event, dict):
+            self.event(event)
+        else:
+            self.signal['comment'].dispatch(comment=stripped)
+
+    def close(self):
+        self.test_number = 0
+        self.signal['tests_completed'].dispatch()
+
+    def mocha_event(self, name, data):
+        if name == 'start':
+            self.event({'type': 'plan', 'total': data.get('total')})
+        elif name in self.MOCHA_STATUSES:
+            self.event({
+                'type': 'test',
+                'name': data.get('fullTitle') or data.get('title'),
+                'status': self.MOCHA_STATUSES[name],
+                'duration_ms': data.get('duration'),
+                'message': data.get('err'),
+                'stack': data.get('stack')
+            })
+
+    def event(self, event):
+        kind = event.get('type')
+        if kind == 'plan' and event.get('total') is not None:
+            self.signal['tests_planned'].dispatch(start=1, end=int(event['total']))
+        elif kind == 'test':
+            self.test_case(event)
+        elif kind == 'comment':
+            self.signal['comment'].dispatch(comment='%s' % event.get('text', ''))
+
+    def test_case(self, event):
+        status = ('%s' % event.get('status', '')).lower()
+        if event.get('number'):
+            self.test_number = int(event['number'])
+        else:
+            self.test_number += 1
+
+        self.signal['test_case'].dispatch(
+            status=status in ('pass', 'passed', 'ok'),
+            number=self.test_number,
+            description='%s' % event.get('name', ''),
+            directive={
+                'type': status.upper() if status in ('skip', 'todo') else None,
+                'description': event.get('reason') or ''
+            }
+        )
+
+        yaml = detail_yaml(
+            message=event.get('message'),
+            stack=event.get('stack'),
+            at=event.get('at'),
+            expected=event.get('expected'),
+            actual=event.get('actual'),
+            duration_ms=event.get('duration_ms')
+        )
+        if yaml:
+            self.signal['test_case_detail'].dispatch(yaml=yaml)
+
+
+PARSERS = {}
+
+
+def register(name, parser_class):
+    """Registers a parser class for the test_output_format setting. Parser
+    classes take an optional source, have feed(line), close() and parse()
+    methods, and dispatch the signals of TapParser."""
+    PARSERS[name] = parser_class
+
+
+def create(name, source=None):
+    """Returns a new parser for an output format, TAP by default."""
+    if name not in PARSERS:
+        logger.debug('unknown output format "%s", using TAP', name)
+
+    return PARSERS.get(name, TapParser)(source)
+
+
+register('tap', TapParser)
+register('junit', JUnitParser)
+register('ndjson', JsonParser)
+
+
+def dispatched(signals):
+    """Returns the number of dispatches of a dict of signals."""
+    return sum(signal.dispatched for signal in signals.values())
 
 
 class Signal(list):
     def __init__(self, *args):
         list.__init__(self, *args)
+        self.dispatched = 0
 
     def add(self, listener):
         list.append(self, listener)
 
     def dispatch(self, *args, **kwargs):
+        self.dispatched += 1
         for listener in self:
             listener(*args, **kwargs)
 
@@ -0,0 +1,118 @@
+import os
+import sys
+import signal
+import threading
+import subprocess
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+def group_options():
+    """Returns the Popen keyword arguments starting the process in its own
+    process group, so it can be stopped along with its children."""
+    if os.name == 'nt':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+
+    if sys.version_info >= (3, 2):
+        # preexec_fn is not safe with the threads of the plugin host
+        return {'start_new_session': True}
+
+    return {'preexec_fn': os.setsid}
+
+
+def limit_command(command, cpu_limit=None, memory_limit=None):
+    """Returns a shell command applying cpu_limit (seconds) and memory_limit
+    (MiB) to every process of command, on POSIX shells."""
+    if os.name == 'nt':
+        return command
+
+    limits = []
+    if cpu_limit:
+        limits.append('ulimit -S -t %d; ' % int(cpu_limit))
+    if memory_limit:
+        limits.append('ulimit -S -v %d; ' % (int(memory_limit) * 1024))
+
+    return ''.join(limits) + command
+
+
+def kill_group(process, sig=signal.SIGTERM):
+    """Sends sig to the process group of a process started with
+    group_options(), or kills its process tree on Windows."""
+    if os.name == 'nt' and process.poll() is not None:
+        return
+
+    try:
+        if os.name == 'nt':
+            subprocess.call(
+                ['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+        else:
+            os.killpg(process.pid, sig)
+    except OSError:
+        # the whole group already exited
+        pass
+
+
+def terminate_group(process, grace=5):
+    """Sends SIGTERM to the process group, then SIGKILL to whatever is left
+    of it after grace seconds (right away when grace is 0)."""
+    kill_group(process)
+    if os.name == 'nt':
+        return
+
+    if not grace:
+        kill_group(process, signal.SIGKILL)
+        return
+
+    timer = threading.Timer(grace, kill_remaining, args=(process,))
+    timer.daemon = True
+    timer.start()
+
+
+def group_alive(process):
+    try:
+        os.killpg(process.pid, 0)
+    except OSError:
+        return False
+
+    return True
+
+
+def kill_remaining(process):
+    if group_alive(process):
+        logger.debug('process group %d still alive, killing it', process.pid)
+        kill_group(process, signal.SIGKILL)
+
+
+def wait(process):
+    """Waits for a process, returning its exit status and the resource usage
+    of it and its descendants as a dict with "cpu" (seconds) and "max_rss"
+    (bytes) keys, or None where it is not available."""
+    if hasattr(os, 'wait4') and process.returncode is None:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+        except OSError:
+            # reaped somewhere else already
+            return process.wait(), None
+
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+
+        return process.returncode, {
+            'cpu': usage.ru_utime + usage.ru_stime,
+            # kilobytes everywhere but on OS X
+            'max_rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        }
+
+    return process.wait(), None
+
+logger.debug('< loading python file "%s"', __name__)
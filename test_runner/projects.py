@@ -0,0 +1,83 @@
+import os
+import time
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+class ProjectDirectoryCache():
+    """Resolves the project directory of a path, i.e. the closest ancestor
+    directory containing one of the spec filenames, caching the result by
+    directory.
+
+    A cached project directory stays valid while the mtime of the marker
+    found in it is unchanged; directories without a project are cached for
+    negative_ttl seconds."""
+
+    def __init__(self, negative_ttl=30):
+        self.negative_ttl = negative_ttl
+        self.spec_filenames = None
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def resolve(self, directory, spec_filenames):
+        spec_filenames = list(spec_filenames)
+        if spec_filenames != self.spec_filenames:
+            logger.debug('spec filenames changed, clearing project directory cache')
+            self.spec_filenames = spec_filenames
+            self.clear()
+
+        entry = self.entries.get(directory)
+        if entry and self.is_valid(entry):
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+
+        project_directory, marker = self.find(directory)
+        if marker:
+            entry = (project_directory, marker, self.mtime(marker))
+        else:
+            entry = (None, None, time.time() + self.negative_ttl)
+
+        self.entries[directory] = entry
+        return project_directory
+
+    def is_valid(self, entry):
+        project_directory, marker, stamp = entry
+        if marker is None:
+            return time.time() < stamp
+
+        return self.mtime(marker) == stamp
+
+    def find(self, directory):
+        path_parts = directory.split(os.path.sep)
+
+        while path_parts:
+            for spec_filename in self.spec_filenames:
+                marker = os.path.normpath(
+                    os.path.sep.join(path_parts + [spec_filename])
+                )
+
+                if os.path.exists(marker):
+                    return (os.path.normpath(os.path.sep.join(path_parts)), marker)
+
+            path_parts.pop()
+
+        return (None, None)
+
+    def mtime(self, path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+logger.debug('< loading python file "%s"', __name__)
@@ -0,0 +1,139 @@
+import heapq
+import collections
+from array import array
+
+from . import details
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+STATUSES = ('PASS', 'FAIL', 'SKIP', 'TODO')
+STATUS_CODES = dict((status, code) for code, status in enumerate(STATUSES))
+
+TestRecord = collections.namedtuple(
+    'TestRecord',
+    ['index', 'status', 'number', 'description', 'duration', 'detail']
+)
+
+
+class TestResults():
+    """Column store of test case results.
+
+    Each test case is a row across typed arrays, texts (descriptions and
+    YAML details) are stored UTF-8 encoded in a single shared arena and
+    referenced by offset and length, so memory grows by a few dozen bytes
+    per test case plus its text. Records are only materialized on access,
+    and details are only parsed when a failure is looked at."""
+
+    def __init__(self):
+        self.statuses = array('b')
+        self.numbers = array('l')
+        self.durations = array('d')
+        self.description_offsets = array('l')
+        self.description_lengths = array('l')
+        self.detail_offsets = array('l')
+        self.detail_lengths = array('l')
+        self.arena = bytearray()
+        self.failures = {}
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.record(index)
+
+    def store(self, text):
+        data = text.encode('utf-8')
+        offset = len(self.arena)
+        self.arena.extend(data)
+
+        return (offset, len(data))
+
+    def load(self, offset, length):
+        if offset < 0:
+            return None
+
+        return self.arena[offset:offset + length].decode('utf-8')
+
+    def append(self, status, number, description, duration=0.0):
+        offset, length = self.store(description)
+
+        self.statuses.append(STATUS_CODES[status])
+        self.numbers.append(number)
+        self.durations.append(duration)
+        self.description_offsets.append(offset)
+        self.description_lengths.append(length)
+        self.detail_offsets.append(-1)
+        self.detail_lengths.append(0)
+
+        return len(self.statuses) - 1
+
+    def rows(self):
+        """Returns the test cases as JSON serializable rows, see extend()."""
+        return [
+            [self.status(index), self.numbers[index], self.description(index),
+             self.durations[index], self.detail(index)]
+            for index in range(len(self))
+        ]
+
+    def extend(self, rows):
+        """Appends test cases from rows returned by rows()."""
+        for status, number, description, duration, detail in rows:
+            index = self.append(status, number, description, duration)
+            if detail is not None:
+                self.set_detail(index, detail)
+
+    def set_detail(self, index, detail):
+        offset, length = self.store(detail)
+        self.detail_offsets[index] = offset
+        self.detail_lengths[index] = length
+
+    def set_duration(self, index, duration):
+        self.durations[index] = duration
+
+    def status(self, index):
+        return STATUSES[self.statuses[index]]
+
+    def description(self, index):
+        return self.load(self.description_offsets[index], self.description_lengths[index])
+
+    def detail(self, index):
+        return self.load(self.detail_offsets[index], self.detail_lengths[index])
+
+    def failure(self, index):
+        """Returns the parsed detail of a test case, see details.failure()."""
+        if index not in self.failures:
+            self.failures[index] = details.failure(self.detail(index))
+
+        return self.failures[index]
+
+    def record(self, index):
+        return TestRecord(
+            index,
+            self.status(index),
+            self.numbers[index],
+            self.description(index),
+            self.durations[index],
+            self.detail(index)
+        )
+
+    def with_status(self, status):
+        code = STATUS_CODES[status]
+        return [self.record(i) for i, c in enumerate(self.statuses) if c == code]
+
+    def failed(self):
+        return self.with_status('FAIL')
+
+    def slowest(self, count):
+        durations = self.durations
+        indexes = heapq.nlargest(count, range(len(durations)), key=durations.__getitem__)
+
+        return [self.record(i) for i in indexes]
+
+logger.debug('< loading python file "%s"', __name__)
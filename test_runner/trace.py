@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import threading
+import collections
+
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+logger.debug('> loading python file "%s"', __name__)
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Span():
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.start, clock(), self.args)
+
+
+class Tracer():
+    """Collects spans, instant events and counters of a run, exportable as
+    Chrome trace event JSON (chrome://tracing, Perfetto)."""
+
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.origin = clock()
+        self.events = []
+        self.open_spans = {}
+        self.counters = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def timestamp(self, when):
+        return int(1e6 * (when - self.origin))
+
+    def event(self, event):
+        event['pid'] = os.getpid()
+        event['tid'] = threading.current_thread().name
+        with self.lock:
+            self.events.append(event)
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def complete(self, name, start, end, args=None):
+        self.event({
+            'name': name,
+            'ph': 'X',
+            'ts': self.timestamp(start),
+            'dur': self.timestamp(end) - self.timestamp(start),
+            'args': args or {}
+        })
+
+    def begin(self, name):
+        self.open_spans[name] = clock()
+
+    def end(self, name, **args):
+        start = self.open_spans.pop(name, None)
+        if start is not None:
+            self.complete(name, start, clock(), args)
+
+    def instant(self, name, **args):
+        self.event({
+            'name': name,
+            'ph': 'i',
+            's': 't',
+            'ts': self.timestamp(clock()),
+            'args': args
+        })
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def export(self, path):
+        events = list(self.events)
+        events.append({
+            'name': 'counters',
+            'ph': 'C',
+            'ts': self.timestamp(clock()),
+            'pid': os.getpid(),
+            'args': dict(self.counters)
+        })
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms',
+                'otherData': {'run': self.name}
+            }, f)
+
+
+class NullSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullTracer():
+    """Tracer doing nothing, used when tracing is disabled."""
+
+    enabled = False
+    null_span = NullSpan()
+
+    def __init__(self, name=None):
+        self.counters = {}
+
+    def span(self, name, **args):
+        return self.null_span
+
+    def complete(self, name, start, end, args=None):
+        pass
+
+    def begin(self, name):
+        pass
+
+    def end(self, name, **args):
+        pass
+
+    def instant(self, name, **args):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def export(self, path):
+        pass
+
+logger.debug('< loading python file "%s"', __name__)
@@ -0,0 +1,87 @@
+"""Corpus of parser inputs and the signals they are expected to dispatch.
+
+Every tests/<corpus>/NAME.<extension> document has a NAME.json dump of the
+lines and signals a parser dispatched for it. Dumps can be written with
+the current parsers, to be checked by hand before they are committed:
+
+    python tests/corpus.py watch junit ndjson
+
+The tap corpus holds what the original TAP parser dispatched and is never
+written again.
+"""
+import os
+import io
+import sys
+import glob
+import json
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIRECTORY)
+
+from test_runner import parsers
+
+TESTS_DIRECTORY = os.path.join(PACKAGE_DIRECTORY, 'tests')
+
+SIGNALS = ('version', 'comment', 'tests_planned', 'test_case', 'test_case_detail', 'tests_completed')
+
+# corpus directory: (document extension, parser class)
+CORPORA = {
+    'tap': ('.tap', parsers.TapParser),
+    'watch': ('.tap', parsers.WatchParser),
+    'junit': ('.xml', parsers.JUnitParser),
+    'ndjson': ('.ndjson', parsers.JsonParser)
+}
+
+
+def record(parser):
+    """Returns the lines and signals dispatched by a parser, as dumped in
+    the corpus."""
+    dump = {'lines': [], 'signals': []}
+    parser.signal['line'].add(dump['lines'].append)
+    for name in SIGNALS:
+        parser.signal[name].add(lambda name=name, **kwargs: dump['signals'].append([name, kwargs]))
+
+    return dump
+
+
+def feed(parser_class, text):
+    """Feeds a document to a new parser one line at a time, returning its
+    dump."""
+    parser = parser_class()
+    dump = record(parser)
+    for line in text.splitlines(True):
+        parser.feed(line)
+    parser.close()
+
+    return dump
+
+
+def documents(corpus):
+    """Yields the name, text and expected dump of the documents of a
+    corpus."""
+    extension = CORPORA[corpus][0]
+    for path in sorted(glob.glob(os.path.join(TESTS_DIRECTORY, corpus, '*' + extension))):
+        with io.open(path, encoding='utf-8') as f:
+            text = f.read()
+        with io.open(path[:-len(extension)] + '.json', encoding='utf-8') as f:
+            expected = json.load(f)
+
+        yield os.path.basename(path), text, expected
+
+
+def write(corpus):
+    if corpus == 'tap':
+        raise SystemExit('the tap corpus records the original parser')
+
+    extension, parser_class = CORPORA[corpus]
+    for path in sorted(glob.glob(os.path.join(TESTS_DIRECTORY, corpus, '*' + extension))):
+        with io.open(path, encoding='utf-8') as f:
+            dump = feed(parser_class, f.read())
+        with open(path[:-len(extension)] + '.json', 'w') as f:
+            json.dump(dump, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    for corpus in sys.argv[1:]:
+        write(corpus)
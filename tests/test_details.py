@@ -0,0 +1,101 @@
+"""details.parse and details.failure on the YAML blocks of TAP 13
+producers (tape, node-tap) and on the blocks written by
+parsers.detail_yaml for the other output formats."""
+import unittest
+
+from test_runner import details
+from test_runner import parsers
+
+
+class ParseTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_tape(self):
+        self.assertEqual(details.parse(
+            "    operator: equal\n"
+            "    expected: 2\n"
+            "    actual:   1\n"
+            "    at: Test.<anonymous> (/project/test/math.js:12:5)\n"
+            "    stack: |-\n"
+            "      Error: should be equal\n"
+            "          at Test.assert (/project/node_modules/tape/lib/test.js:224:54)\n"
+        ), {
+            'operator': 'equal',
+            'expected': 2,
+            'actual': 1,
+            'at': 'Test.<anonymous> (/project/test/math.js:12:5)',
+            'stack': 'Error: should be equal\n    at Test.assert (/project/node_modules/tape/lib/test.js:224:54)'
+        })
+
+    def test_node_tap(self):
+        self.assertEqual(details.parse(
+            "  ---\n"
+            "  wanted: 'it''s'\n"
+            '  found: "its"\n'
+            "  compare: ===\n"
+            "  at:\n"
+            "    line: 7\n"
+            "    column: 3\n"
+            "    file: test/strings.js\n"
+            "  tags: [slow, \"io\"]\n"
+            "  # a comment\n"
+            "  todo: ~\n"
+            "  ...\n"
+        ), {
+            'wanted': "it's",
+            'found': 'its',
+            'compare': '===',
+            'at': {'line': 7, 'column': 3, 'file': 'test/strings.js'},
+            'tags': '[slow, "io"]',
+            'todo': None
+        })
+
+    def test_folded_scalar_and_sequence(self):
+        self.assertEqual(details.parse(
+            "message: >\n"
+            "  expected the list\n"
+            "  to be sorted\n"
+            "actual:\n"
+            "  - 3\n"
+            "  - two\n"
+            "  - true\n"
+        ), {
+            'message': 'expected the list to be sorted',
+            'actual': [3, 'two', True]
+        })
+
+    def test_detail_yaml_round_trip(self):
+        fields = {
+            'message': "it's not\na number",
+            'severity': 'error',
+            'at': 'test/math.spec.js:12',
+            'duration_ms': 1.5
+        }
+
+        self.assertEqual(details.parse(parsers.detail_yaml(**fields)), fields)
+
+
+class FailureTest(unittest.TestCase):
+    def test_aliases(self):
+        failure = details.failure("  message: differs\n  wanted: 2\n  found: 1\n")
+
+        self.assertEqual(failure['message'], 'differs')
+        self.assertEqual(failure['expected'], 2)
+        self.assertEqual(failure['actual'], 1)
+        self.assertEqual(failure['severity'], None)
+
+    def test_not_a_mapping(self):
+        self.assertEqual(details.failure("- 1\n- 2\n")['actual'], [1, 2])
+        self.assertEqual(details.failure(None)['data'], {})
+
+    def test_describe(self):
+        failure = details.failure("  message: differs\n  at:\n    line: 7\n    file: a.js\n")
+
+        self.assertEqual(
+            details.describe('adds', failure),
+            '[FAIL] adds\nmessage: differs\nat:\n    file: a.js\n    line: 7\n'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
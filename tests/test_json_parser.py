@@ -0,0 +1,38 @@
+"""parsers.JsonParser checked against the corpus in tests/ndjson: plan,
+test and comment objects, mocha json-stream arrays and lines that are not
+JSON events."""
+import io
+import unittest
+
+import corpus
+from test_runner import parsers
+
+
+class JsonParserTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_corpus(self):
+        for name, text, expected in corpus.documents('ndjson'):
+            self.assertEqual(corpus.feed(parsers.JsonParser, text), expected, name)
+
+    def test_parse(self):
+        for name, text, expected in corpus.documents('ndjson'):
+            parser = parsers.JsonParser(io.StringIO(text))
+            dump = corpus.record(parser)
+            parser.parse()
+
+            self.assertEqual(dump, expected, name)
+
+    def test_numbers_restart_after_close(self):
+        parser = parsers.JsonParser()
+        dump = corpus.record(parser)
+        for run in range(2):
+            parser.feed('{"type": "test", "name": "adds", "status": "pass"}\n')
+            parser.close()
+        numbers = [kwargs['number'] for name, kwargs in dump['signals'] if name == 'test_case']
+
+        self.assertEqual(numbers, [1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""parsers.JUnitParser checked against the corpus in tests/junit: nested
+suites, failures, errors and skipped tests, and build tool banners before
+the first element."""
+import io
+import unittest
+
+import corpus
+from test_runner import parsers
+
+
+class JUnitParserTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_corpus(self):
+        for name, text, expected in corpus.documents('junit'):
+            self.assertEqual(corpus.feed(parsers.JUnitParser, text), expected, name)
+
+    def test_parse(self):
+        for name, text, expected in corpus.documents('junit'):
+            parser = parsers.JUnitParser(io.StringIO(text))
+            dump = corpus.record(parser)
+            parser.parse()
+
+            self.assertEqual(dump, expected, name)
+
+    def test_invalid_xml_keeps_reported_tests(self):
+        dump = corpus.feed(parsers.JUnitParser, (
+            '<testsuite tests="2">\n'
+            '<testcase name="first"/>\n'
+            '<testcase name="second"></testsuite>\n'
+            '<testcase name="third"/>\n'
+        ))
+        signals = [name for name, kwargs in dump['signals']]
+
+        self.assertEqual(signals, ['tests_planned', 'test_case', 'tests_completed'])
+        self.assertEqual(len(dump['lines']), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Round trips of history.RunLog through its files: runs appended by one
+log are read back by the next, and a record left partly written by an
+interrupted run is dropped."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from test_runner import history
+from test_runner import results as test_results
+
+
+def run(*tests):
+    results = test_results.TestResults()
+    for number, (status, description, duration) in enumerate(tests, 1):
+        results.append(status, number, description, duration)
+
+    return results
+
+
+class RunLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache', 'runs.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        log = history.RunLog(self.path)
+        log.append(run(('PASS', 'adds', 1.5), ('FAIL', 'subtracts\nmultiline', 2.0)))
+        log.append(run(('FAIL', 'adds', 2.5), ('SKIP', 'divides', 0.0)))
+
+        log = history.RunLog(self.path)
+
+        self.assertEqual(log.last_run, 2)
+        self.assertEqual(log.names, ['adds', 'subtracts multiline', 'divides'])
+        self.assertEqual(log.results('adds'), [('PASS', 1.5), ('FAIL', 2.5)])
+        self.assertEqual(log.results('subtracts multiline'), [('FAIL', 2.0)])
+        self.assertEqual(log.results('adds', runs=1), [('FAIL', 2.5)])
+        self.assertEqual(log.results('unknown'), [])
+
+    def test_partly_written_record_is_dropped(self):
+        log = history.RunLog(self.path)
+        log.append(run(('PASS', 'adds', 1.0)))
+        with open(self.path, 'ab') as f:
+            f.write(history.RECORD.pack(2, 0, 1, 3.0)[:-3])
+
+        log = history.RunLog(self.path)
+
+        self.assertEqual(os.path.getsize(self.path), history.RECORD.size)
+        self.assertEqual(log.last_run, 1)
+
+        log.append(run(('FAIL', 'adds', 2.0)))
+
+        self.assertEqual(history.RunLog(self.path).results('adds'), [('PASS', 1.0), ('FAIL', 2.0)])
+
+    def test_flaky(self):
+        log = history.RunLog(self.path)
+        for status in ('PASS', 'FAIL', 'PASS', 'PASS'):
+            log.append(run((status, 'flips', 1.0), ('PASS', 'stable', 1.0)))
+
+        flaky = history.RunLog(self.path).flaky()
+
+        self.assertEqual([summary['description'] for summary in flaky], ['flips'])
+        self.assertAlmostEqual(flaky[0]['flake_score'], 2 / 3.0)
+        self.assertEqual(flaky[0]['pass_rate'], 0.75)
+
+
+if __name__ == '__main__':
+    unittest.main()
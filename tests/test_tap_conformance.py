@@ -0,0 +1,40 @@
+"""Conformance of parsers.TapParser with the TAP corpus in tests/tap.
+
+Every tests/tap/NAME.tap document has a NAME.json dump of the lines and
+signals it produced with the original, regex per line, parser. The
+single-pass parser has to dispatch the same signals, with the same
+arguments and in the same order, whether it reads the document from a
+source or is fed one line at a time.
+
+Run from the package directory:
+
+    python -m unittest discover tests
+"""
+import io
+import unittest
+
+import corpus
+from test_runner import parsers
+
+
+class TapConformanceTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_corpus_is_not_empty(self):
+        self.assertTrue(list(corpus.documents('tap')))
+
+    def test_parse(self):
+        for name, text, expected in corpus.documents('tap'):
+            parser = parsers.TapParser(io.StringIO(text))
+            dump = corpus.record(parser)
+            parser.parse()
+
+            self.assertEqual(dump, expected, name)
+
+    def test_feed(self):
+        for name, text, expected in corpus.documents('tap'):
+            self.assertEqual(corpus.feed(parsers.TapParser, text), expected, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
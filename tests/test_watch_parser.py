@@ -0,0 +1,27 @@
+"""Cycle splitting of parsers.WatchParser, checked against the corpus in
+tests/watch: reruns starting at a version line, ending at a trailing plan
+or at trailing "# tests N" comments, and output that is not TAP."""
+import unittest
+
+import corpus
+from test_runner import parsers
+
+
+class WatchParserTest(unittest.TestCase):
+    maxDiff = None
+
+    def test_corpus(self):
+        for name, text, expected in corpus.documents('watch'):
+            self.assertEqual(corpus.feed(parsers.WatchParser, text), expected, name)
+
+    def test_numbers_are_no_plan(self):
+        dump = corpus.feed(parsers.WatchParser, '1..3\nok 1\n2024\nok 2\nok 3\n')
+        signals = [name for name, kwargs in dump['signals']]
+
+        self.assertEqual(signals.count('tests_planned'), 1)
+        self.assertEqual(signals.count('tests_completed'), 1)
+        self.assertEqual(signals[-1], 'tests_completed')
+
+
+if __name__ == '__main__':
+    unittest.main()